@@ -5,10 +5,13 @@ import mago.types
 
 # from mago.transaction import Transaction
 from mago.field import Field, ReferenceField, ConstantField, EnumField, \
-      FieldError, OneToMany, ManyToOne
+      FieldError, OneToMany, ManyToOne, ManyToMany
 from mago.cursor import ASC, DESC
 from mago.connection import connect
+from mago.codec import register_codec
 import mago.model
+from mago.session import Session
+from mago.index import sync_indexes
 
 
 Model = mago.model.Model
@@ -0,0 +1,168 @@
+"""Async flavor of mago. The same models are used from asyncio code
+through their `a*` methods (afind, afind_one, asave, async_sync, adelete) and
+Session.aflush()/acommit(), on top of a pluggable async driver:
+
+    mago.aio.connect("mydb")                     # motor by default
+    user = await User.afind_one({"name": "injaon"})
+    async for address in Address.afind({"user": user.id}):
+        ...
+    await user.asave()
+
+A driver is any object with the methods of AsyncDriver. Models with a
+`Meta.db_alias` use the driver connected under that alias:
+
+    mago.aio.connect("stats", alias="analytics")
+"""
+
+import time
+import mago.connection
+import mago.cursor
+import mago.decorators
+import mago.monitoring
+import mago.session
+
+
+class AsyncDriver(object):
+    """Interface of the async backends. Collections are given by name."""
+
+    async def find_one(self, coll, spec, read_preference=None):
+        raise NotImplementedError()
+
+    def find(self, coll, spec, read_preference=None, **kwargs):
+        """Returns an async iterator over the documents"""
+        raise NotImplementedError()
+
+    async def save(self, coll, doc):
+        """Inserts or replaces the document"""
+        raise NotImplementedError()
+
+    async def update(self, coll, spec, update):
+        raise NotImplementedError()
+
+    async def remove(self, coll, spec):
+        raise NotImplementedError()
+
+    async def bulk_write(self, coll, ops, ordered=True):
+        """`ops` is a list of (oper, spec, doc), with oper in "insert",
+        "replace" (upsert), "update" or "remove"."""
+        raise NotImplementedError()
+
+
+class MotorDriver(AsyncDriver):
+    """Driver for motor (asyncio)"""
+
+    def __init__(self, database, *args, **kwargs):
+        try:
+            from motor.motor_asyncio import AsyncIOMotorClient
+        except ImportError:
+            raise ImportError("motor is required by the default async "
+                              "driver: pip install motor")
+        self.client = AsyncIOMotorClient(*args, **kwargs)
+        self.database = self.client[database]
+
+    def _read(self, coll, read_preference):
+        if read_preference is None:
+            return self.database[coll]
+        return self.database[coll].with_options(
+            read_preference=read_preference)
+
+    async def find_one(self, coll, spec, read_preference=None):
+        return await self._read(coll, read_preference).find_one(spec)
+
+    def find(self, coll, spec, read_preference=None, **kwargs):
+        return self._read(coll, read_preference).find(spec, **kwargs)
+
+    async def save(self, coll, doc):
+        return await self.database[coll].replace_one(
+            {"_id": doc["_id"]}, doc, upsert=True)
+
+    async def update(self, coll, spec, update):
+        return await self.database[coll].update_one(spec, update)
+
+    async def remove(self, coll, spec):
+        return await self.database[coll].delete_one(spec)
+
+    async def bulk_write(self, coll, ops, ordered=True):
+        return await self.database[coll].bulk_write(
+            mago.session.bulk_requests(ops), ordered=ordered)
+
+
+@mago.decorators.singleton
+class AsyncConnection(object):
+    """Holds the async drivers, by alias"""
+
+    def __init__(self):
+        self._drivers = {}                  # alias => driver
+
+    @property
+    def driver(self):
+        return self._drivers.get(mago.connection.DEFAULT_ALIAS)
+
+    def connect(self, database=None, *args, **kwargs):
+        driver = kwargs.pop("driver", None)
+        alias = kwargs.pop("alias", mago.connection.DEFAULT_ALIAS)
+        if driver is None:
+            if not database:
+                raise TypeError("A database name is required to connect.")
+            driver = MotorDriver(database, *args, **kwargs)
+        self._drivers[alias] = driver
+        return driver
+
+
+def connect(*args, **kwargs):
+    """Initializes the async driver (motor, unless `driver` is given) of
+    `alias` (the default one unless told otherwise) and returns it."""
+    return AsyncConnection().connect(*args, **kwargs)
+
+
+def get_driver(alias=mago.connection.DEFAULT_ALIAS):
+    driver = AsyncConnection()._drivers.get(alias)
+    if driver is None:
+        raise RuntimeError('No async connection for "{}", call '
+                           'mago.aio.connect()'.format(alias))
+    return driver
+
+
+class AsyncCursor(object):
+    """Async iterator over the models of a query. The find is reported
+    when the iteration ends, as Cursor does."""
+
+    def __init__(self, modelcls, spec=None, **kwargs):
+        self.session = kwargs.pop("session", None)
+        self._modelcls = modelcls
+        self._spec = spec or {}
+        self._event = None
+        self._published = False
+        if modelcls._read_preference is not None:
+            kwargs.setdefault("read_preference", modelcls._read_preference)
+        self._docs = get_driver(modelcls._db_alias).find(
+            modelcls.collection_name(), self._spec, **kwargs).__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._event is None and not self._published and \
+           mago.monitoring.enabled():
+            self._event = mago.monitoring.QueryEvent(
+                self._modelcls, "find", filter=self._spec)
+        start = time.perf_counter()
+        try:
+            doc = await self._docs.__anext__()
+        except StopAsyncIteration:
+            self._publish(start)
+            raise
+        if self._event is not None:
+            self._event.duration += time.perf_counter() - start
+            self._event.count += 1
+        return mago.cursor.cast(self._modelcls, self.session, doc)
+
+    def _publish(self, start):
+        event, self._event = self._event, None
+        self._published = True
+        if event is not None:
+            event.duration += time.perf_counter() - start
+            mago.monitoring.publish(event)
+
+    async def to_list(self):
+        return [model async for model in self]
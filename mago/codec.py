@@ -0,0 +1,103 @@
+"""Codecs for the non-native objects stored inside models.
+
+A class is registered with a short tag; its instances are stored as a
+dict with the tag under TYPE_KEY and turned back into objects when the
+document is read:
+
+    mago.register_codec(Point, "pt", fields=("x", "y"))
+    mago.register_codec(Money, "money", encode=lambda m: {"c": m.cents},
+                        decode=lambda d: Money(d["c"]))
+"""
+from operator import attrgetter
+import mago.types
+
+
+TYPE_KEY = "__type__"
+_by_tag = {}                               # tag => codec
+_by_class = {}                             # class => codec
+
+
+class Codec(object):
+    """Knows how to encode/decode the instances of one class. Without
+    custom callables, the attributes listed in `fields` (or the instance
+    `__dict__`) are stored."""
+
+    def __init__(self, cls, tag, encode=None, decode=None, fields=None):
+        self.cls = cls
+        self.tag = tag
+        self.fields = tuple(fields) if fields else None
+        self._custom_encode = encode
+        self._custom_decode = decode
+        # the plan, computed once per class
+        if self.fields:
+            getter = attrgetter(*self.fields)
+            if len(self.fields) == 1:
+                self._values = lambda obj: (getter(obj),)
+            else:
+                self._values = getter
+        self._slots = not any("__dict__" in vars(klass)
+                              for klass in cls.__mro__)
+        if self._slots and not (self.fields or encode):
+            raise ValueError("{} has no __dict__, `fields` are required"
+                             .format(cls))
+
+    def encode(self, obj):
+        if self._custom_encode:
+            doc = dict(self._custom_encode(obj))
+        elif self.fields:
+            doc = dict(zip(self.fields, self._values(obj)))
+        else:
+            doc = dict(obj.__dict__)
+        for key, val in doc.items():
+            if type(val) not in mago.types.NATIVE:
+                doc[key] = encode(val)
+        doc[TYPE_KEY] = self.tag
+        return doc
+
+    def decode(self, doc):
+        state = {}
+        for key, val in doc.items():
+            if key == TYPE_KEY:
+                continue
+            if val.__class__ is dict and TYPE_KEY in val:
+                val = decode(val)
+            state[key] = val
+        if self._custom_decode:
+            return self._custom_decode(state)
+
+        obj = self.cls.__new__(self.cls)
+        if self._slots:
+            for key, val in state.items():
+                setattr(obj, key, val)
+        else:
+            obj.__dict__.update(state)
+        return obj
+
+
+def register_codec(cls, tag, encode=None, decode=None, fields=None):
+    """Registers `cls` to be stored under the type tag `tag`."""
+    if tag in _by_tag and _by_tag[tag].cls is not cls:
+        raise ValueError("Type tag '{}' already registered for {}".format(
+            tag, _by_tag[tag].cls))
+    codec = Codec(cls, tag, encode, decode, fields)
+    _by_tag[tag] = codec
+    _by_class[cls] = codec
+    return codec
+
+
+def encode(obj):
+    """Translates a non-model and non-native object to dict"""
+    codec = _by_class.get(obj.__class__)
+    if codec is not None:
+        return codec.encode(obj)
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError("No codec registered for {}".format(obj.__class__))
+
+
+def decode(doc):
+    """Translates a dict with a type tag back to its object"""
+    codec = _by_tag.get(doc[TYPE_KEY])
+    if codec is None:
+        raise TypeError("Unknown type tag '{}'".format(doc[TYPE_KEY]))
+    return codec.decode(doc)
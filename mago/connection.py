@@ -1,26 +1,42 @@
 """ The wrapper for pymongo's connection stuff. """
 from bson.objectid import ObjectId
-from pymongo import Connection as PyConnection
+from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure
 import mago
 from mago.cursor import Cursor
 # import mago.transaction as tran
 import mago.decorators
+import mago.types
 import urllib.parse as urlparse
 
 
+DEFAULT_ALIAS = "default"
+
+
 @mago.decorators.singleton
 class Connection(object):
-    """This just caches a pymongo connection and adds a few shortcuts."""
+    """This just caches pymongo connections and adds a few shortcuts.
+    Every connection is registered under an alias (DEFAULT_ALIAS unless
+    told otherwise) and models pick theirs with `Meta.db_alias`."""
 
     connection = None
     _host = None
     _port = None
     _database = None
 
+    def __init__(self):
+        self._aliases = {}                  # alias => (connection, db)
+
     def connect(self, database=None, *args, **kwargs):
-        """ Wraps a pymongo connection.
+        """ Wraps a pymongo MongoClient. `alias` names the connection and
+        `pool_size` sets the max number of sockets in its pool.
         TODO: Allow some of the URI stuff."""
+        alias = kwargs.pop("alias", DEFAULT_ALIAS)
+        pool_size = kwargs.pop("pool_size", None)
+        if pool_size is not None:
+            option = "maxPoolSize" if mago.types.PYMONGO3 else "max_pool_size"
+            kwargs[option] = pool_size
+
         if "uri" in kwargs:
             uri = kwargs.pop("uri")
             parsed_uri = urlparse.urlparse(uri)
@@ -37,25 +53,37 @@ class Connection(object):
         elif not database:
             raise TypeError("A database name or uri is required to connect.")
 
-        self._database = database
-        self.connection = PyConnection(*args, **kwargs)
+        connection = MongoClient(*args, **kwargs)
+        self._aliases[alias] = (connection, database)
+        for model in mago.types.models.values():
+            if model._db_alias == alias:
+                # rebound on next use
+                model._collection = None
+        if alias == DEFAULT_ALIAS:
+            self._database = database
+            self.connection = connection
         # recover from possible errors.
         # tran.recovery()
-        return self.connection
+        return connection
+
+    def get_connection(self, alias=DEFAULT_ALIAS):
+        """ Retrieves the pymongo connection of an alias. """
+        if alias not in self._aliases:
+            raise ConnectionFailure('No connection for "{}"'.format(alias))
+        return self._aliases[alias][0]
 
-    def get_database(self, database=None):
+    def get_database(self, database=None, alias=DEFAULT_ALIAS):
         """ Retrieves a database from an existing connection. """
-        if not self.connection:
-            raise ConnectionFailure('No connection')
+        connection = self.get_connection(alias)
         if not database:
-            if not self._database:
+            database = self._aliases[alias][1]
+            if not database:
                 raise Exception('No database submitted')
-            database = self._database
-        return self.connection[database]
+        return connection[database]
 
-    def get_collection(self, collection, database=None):
+    def get_collection(self, collection, database=None, alias=DEFAULT_ALIAS):
         """ Retrieve a collection from an existing connection. """
-        return self.get_database(database=database)[collection]
+        return self.get_database(database=database, alias=alias)[collection]
 
 
 def connect(*args, **kwargs):
@@ -4,16 +4,84 @@ that a result dict is wrapped in a Model to keep everything
 clean.
 """
 
+from collections import deque
+import time
 from pymongo.cursor import Cursor as PyCursor
 from pymongo import ASCENDING as ASC
 from pymongo import DESCENDING as DESC
+import mago
+import mago.monitoring
+import mago.types
 
 
-def cast(modelcls, session, **doc):
-    model = modelcls(**doc)
+# used when the cursor has no explicit batch size
+DEFAULT_BATCH_SIZE = 100
+
+# read modes
+MODELS, RAW, TUPLES = "models", "raw", "tuples"
+
+# private attribute of pymongo's Cursor that holds the projection
+_PROJECTION = "_Cursor__projection" if mago.types.PYMONGO3 \
+  else "_Cursor__fields"
+
+
+class Row(object):
+    """Base for the lightweight rows returned by Cursor.as_tuples(). Every
+    row class has one slot per field and behaves like a tuple."""
+    __slots__ = ()
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __getitem__(self, index):
+        return getattr(self, self.__slots__[index])
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return "Row({})".format(", ".join(
+            "{}={!r}".format(name, val) for name, val in
+            zip(self.__slots__, self)))
+
+    def _asdict(self):
+        return dict(zip(self.__slots__, self))
+
+
+def row_class(names):
+    """Creates a Row class for the given field names (dots in nested
+    names become underscores)."""
+    slots = tuple(name.replace(".", "_") for name in names)
+    paths = tuple(tuple(name.split(".")) for name in names)
+
+    def _from_doc(cls, doc):
+        row = object.__new__(cls)
+        for slot, path in zip(slots, paths):
+            val = doc
+            for key in path:
+                val = val.get(key) if isinstance(val, dict) else None
+            object.__setattr__(row, slot, val)
+        return row
+
+    return type("Row", (Row,), {"__slots__": slots,
+                                "_from_doc": classmethod(_from_doc)})
+
+
+def cast(modelcls, session, doc, fields=None):
+    """Builds a model from a document read from the db. With a session,
+    the instance that was already loaded for the same document is returned
+    instead. `fields` flags a document read with a projection."""
+    if session:
+        model = session._lookup(modelcls, doc.get("_id"))
+        if model is not None:
+            return model
+    model = modelcls._from_db(doc)
+    model._projection = fields
     if session:
-        model._session = session
-        return session._register_clean(model)   # TODO: WTF!?
+        return session._register_clean(model)
     return model
 
 
@@ -23,22 +91,182 @@ class Cursor(PyCursor):
     instead of dicts. It can operate with session"""
 
     def __init__(self, modelcls,  *args, **kwargs):
-        self.session = kwargs.pop("session", None)
+        self._setup(modelcls, kwargs.pop("session", None))
+        collection = modelcls.collection()
+        if mago.types.PYMONGO3 and "read_preference" in kwargs:
+            # pymongo 3 takes it from the collection
+            collection = collection.with_options(
+                read_preference=kwargs.pop("read_preference"))
+        super().__init__(collection, *args, **kwargs)
+
+    def _setup(self, modelcls, session):
+        # pymongo's Cursor.session is its (read-only) ClientSession
+        self._mago_session = session
         self._order_entries = []
         self._modelcls = modelcls
-        super().__init__(modelcls.collection(), *args, **kwargs)
+        self._batch_size = 0
+        self._prefetch = []
+        self._buffer = deque()
+        self._mode = MODELS
+        self._fields = None
+        self._row_class = None
+        self._event = None                # QueryEvent of the iteration
+        self._published = False
+
+    def _read_batch(self):
+        """Reads the next batch of raw documents."""
+        size = self._batch_size or DEFAULT_BATCH_SIZE
+        docs = []
+        while len(docs) < size:
+            try:
+                docs.append(PyCursor.__next__(self))
+            except StopIteration:
+                break
+        return docs
+
+    def _query(self):
+        """The filter, projection and sort of the query, as reported"""
+        return {"filter": getattr(self, "_Cursor__spec", None),
+                "projection": getattr(self, _PROJECTION, None),
+                "sort": getattr(self, "_Cursor__ordering", None)}
+
+    def _explain(self):
+        query = self._query()
+        cursor = self.collection.find(query["filter"], query["projection"])
+        if query["sort"]:
+            cursor.sort(query["sort"])
+        return cursor.explain()
 
     def __next__(self):
-        value = super().__next__()
-        return cast(**value)
+        if self._event is None:
+            if self._published or not mago.monitoring.enabled():
+                return self._next()
+            self._event = mago.monitoring.QueryEvent(
+                self._modelcls, "find", collection=self.collection.name,
+                **self._query())
+        start = time.perf_counter()
+        try:
+            value = self._next()
+        except StopIteration:
+            self._event.duration += time.perf_counter() - start
+            self._publish()
+            raise
+        self._event.duration += time.perf_counter() - start
+        self._event.count += 1
+        return value
+
+    def _publish(self):
+        """Reports the find to the listeners, once"""
+        event, self._event = self._event, None
+        self._published = True
+        if event is not None:
+            mago.monitoring.publish(event, self._explain)
+
+    def close(self):
+        if self._event is not None:
+            self._publish()
+        return super().close()
+
+    def count(self, with_limit_and_skip=False):
+        with mago.monitoring.watch(self._modelcls, "count", self._explain,
+                                   collection=self.collection.name,
+                                   filter=self._query()["filter"]) as event:
+            event.count = super().count(with_limit_and_skip)
+        return event.count
+
+    def _read_one(self, index):
+        """The raw document at `index`, reported as a find"""
+        with mago.monitoring.watch(self._modelcls, "find", self._explain,
+                                   collection=self.collection.name,
+                                   **self._query()) as event:
+            value = PyCursor.__getitem__(self, index)
+            event.count = 1
+        return value
+
+    def _next(self):
+        if self._mode is RAW:
+            return super().__next__()
+        if self._mode is TUPLES:
+            return self._row_class._from_doc(super().__next__())
+        if not self._prefetch:
+            value = super().__next__()
+            return cast(self._modelcls, self._mago_session, value,
+                        self._fields)
+
+        if not self._buffer:
+            batch = [cast(self._modelcls, self._mago_session, doc,
+                          self._fields)
+                     for doc in self._read_batch()]
+            mago.field.prefetch_references(batch, self._prefetch,
+                                           self._mago_session)
+            self._buffer.extend(batch)
+        if not self._buffer:
+            raise StopIteration
+        return self._buffer.popleft()
 
     def __getitem__(self, index):
-        value = super().__getitem__(index)
-        # I hear you like cursors... so we put a cursor inside a cursor...
-        if type(value) == self.__class__:   # TODO: Probably wrong!
+        if isinstance(index, slice):
+            # I hear you like cursors... so we put a cursor inside a cursor...
+            return super().__getitem__(index)
+        value = self._read_one(index)
+
+        if self._mode is RAW:
             return value
+        if self._mode is TUPLES:
+            return self._row_class._from_doc(value)
+        model = cast(self._modelcls, self._mago_session, value,
+                     self._fields)
+        if self._prefetch:
+            mago.field.prefetch_references([model], self._prefetch,
+                                           self._mago_session)
+        return model
+
+    def batch_size(self, batch_size):
+        """Same as pymongo's, but keeps track of the value."""
+        super().batch_size(batch_size)
+        self._batch_size = batch_size
+        return self
+
+    def prefetch(self, *paths):
+        """Resolves the given ReferenceFields (dotted paths for nested
+        references) for a whole batch at once, instead of one query per
+        model and attribute access."""
+        self._prefetch.extend(paths)
+        return self
 
-        return cast(**value)
+    def fields(self, *names):
+        """Only fetches the given fields (`_id` is always sent by the
+        server). Models built from a partial document can be changed with
+        sync(), but save() refuses to replace the whole document."""
+        # pymongo has no setter for the projection
+        self._Cursor__check_okay_to_chain()
+        self._fields = names
+        setattr(self, _PROJECTION, dict.fromkeys(names, 1))
+        return self
+
+    def raw(self):
+        """Returns the documents as plain dicts, without building models."""
+        self._mode = RAW
+        return self
+
+    def as_tuples(self, *names):
+        """Returns the documents as lightweight tuple-like rows with the
+        given fields, or the ones passed to fields()."""
+        names = names or self._fields
+        if not names:
+            raise ValueError("as_tuples() requires the fields of the rows.")
+        if not self._fields:
+            self.fields(*names)
+        self._mode = TUPLES
+        self._row_class = row_class(names)
+        return self
+
+    def rewind(self):
+        self._buffer.clear()
+        if self._event is not None:
+            self._publish()
+        self._published = False
+        return super().rewind()
 
     def order(self, **kwargs):            # TODO: ???
         if len(kwargs) != 1:
@@ -54,34 +282,98 @@ class Cursor(PyCursor):
 
 
 class RelationCursor(Cursor):
-    def __init__(self, obj, related, bidirectional, *args, **kwargs):
-        super().__init__(related.collection(), *args, **kwargs)
+    """Iterates over the edges (`from`/`to` documents) of a relation and
+    returns the related models. Edges are read in batches and every batch
+    is resolved with a single `$in` query."""
+
+    def __init__(self, obj, related, coll, *args, **kwargs):
+        self._setup(related, kwargs.pop("session", obj._session))
+        PyCursor.__init__(self, coll, *args, **kwargs)
         self._obj = obj
         self._relatedcls = related
-        self._bi = bidirectional
+        self._coll = coll
         self._added = []
 
-    def __next__(self):
-        value = super().__next__()
-        value = value["from"] if value["to"] == self._obj.id else value["to"]
-        return cast(self._relatedcls, self._obj._session,
-                    **self._relatedcls.find_one({"_id": value}))
+    def _target(self, edge):
+        """Returns the id in the other side of the edge"""
+        return edge["from"] if edge["to"] == self._obj.id else edge["to"]
+
+    def _resolve(self, ids):
+        """Fetches the related documents for `ids` with one query, in the
+        same order, as models, dicts or rows depending on the read mode.
+        Dangling edges are skipped."""
+        if not ids:
+            return []
+        models = {}
+        missing = set(ids)
+        if self._mago_session and self._mode is MODELS:
+            for oid in ids:
+                model = self._mago_session._lookup(self._relatedcls,
+                                                   oid)
+                if model is not None:
+                    models[oid] = model
+                    missing.discard(oid)
+        if missing:
+            spec = {"_id": {"$in": list(missing)}}
+            projection = dict.fromkeys(self._fields, 1) if self._fields \
+              else None
+            coll = self._relatedcls.collection()
+            with mago.monitoring.watch(
+                    self._relatedcls, "find",
+                    mago.monitoring.explainer(coll, spec, projection),
+                    filter=spec, projection=projection) as event:
+                for doc in coll.find(spec, projection):
+                    models[doc["_id"]] = self._wrap(doc)
+                    event.count += 1
+        return [models[oid] for oid in ids if oid in models]
+
+    def _wrap(self, doc):
+        if self._mode is RAW:
+            return doc
+        if self._mode is TUPLES:
+            return self._row_class._from_doc(doc)
+        return cast(self._relatedcls, self._mago_session, doc,
+                    self._fields)
+
+    def _next(self):
+        while not self._buffer:
+            ids = [self._target(edge) for edge in self._read_batch()]
+            if not ids:
+                raise StopIteration
+            models = self._resolve(ids)
+            if self._prefetch and self._mode is MODELS:
+                mago.field.prefetch_references(models, self._prefetch,
+                                               self._mago_session)
+            self._buffer.extend(models)
+        return self._buffer.popleft()
 
     def __getitem__(self, index):
-        value = super().__getitem__(index)
-        value = value["from"] if value["to"] == self._obj.id else value["to"]
-        return cast(self._relatedcls, self._obj._session,
-                    **self._relatedcls.find_one({"_id": value}))
+        if isinstance(index, slice):
+            return PyCursor.__getitem__(self, index)
+        value = self._read_one(index)
+
+        res = self._resolve([self._target(value)])
+        if not res:
+            raise IndexError("no such item for Cursor instance")
+        if self._prefetch and self._mode is MODELS:
+            mago.field.prefetch_references(res, self._prefetch,
+                                           self._mago_session)
+        return res[0]
 
     def append(self, model):
+        edge = {"from": self._obj.id, "to": model.id}
         if self._obj._session:
-            obj._session.add_operation(self._coll.insert,
-                                       {"from": self._obj.id,"to": model.id})
+            self._obj._session.add_operation(self._coll.insert, edge)
             self._obj._session.add(model)
         else:
-            self._coll.insert({"from": self._obj.id,"to": model.id})
+            self._coll.insert(edge)
         self._added.append(model)
 
     def order(self):
-        raise NotImplemented("Not implemented yet")
-#
+        raise NotImplementedError("Not implemented yet")
+
+    def fields(self, *names):
+        """Only fetches the given fields of the related models, the edges
+        are always read whole."""
+        self._fields = names
+        return self
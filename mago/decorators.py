@@ -14,16 +14,16 @@ class notinstancemethod(object):
 
 
 def track_changes(func):
+    """Records the change of a key that is not a declared field, the field
+    descriptors record their own (see Model._track_change())"""
     def _track(self, name, *args, **kwargs):
+        if name in self._fields:
+            return func(self, name, *args, **kwargs)
         old = self.get(name, mago.UnSet)
         res = func(self, name, *args, **kwargs)
-
-        if self._session and old != self.get(name, mago.UnSet) and  \
-          self._session.is_active:
-            self._session._register_change(self, name, old)
+        self._track_change(name, old)
         return res
 
-
     return _track
 
 
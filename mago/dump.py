@@ -0,0 +1,129 @@
+"""Streaming export and import of a model's collection, as JSON Lines
+(MongoDB extended JSON, one document per line) or as concatenated BSON
+documents (the format of mongodump):
+
+    User.export_to("users.jsonl", query={"active": True})
+    User.import_from("users.bson", batch_size=5000, progress=print)
+
+At most `batch_size` documents are kept in memory. Both return the
+number of documents, the time taken and the rate (docs per second).
+"""
+import struct
+import time
+from bson import BSON
+from bson import json_util
+import mago.field
+import mago.session
+
+
+JSONL, BSON_FORMAT = "jsonl", "bson"
+FORMATS = {".jsonl": JSONL, ".json": JSONL, ".bson": BSON_FORMAT}
+DUMP_BATCH_SIZE = 1000
+
+
+def _format(path, format):
+    if format is None:
+        for ext, name in FORMATS.items():
+            if str(path).endswith(ext):
+                return name
+    if format not in (JSONL, BSON_FORMAT):
+        raise ValueError("Unknown format {!r}, use 'jsonl' or 'bson'".format(
+            format))
+    return format
+
+
+def _stats(count, start):
+    seconds = time.perf_counter() - start
+    return {"count": count, "seconds": seconds,
+            "rate": count / seconds if seconds else 0.0}
+
+
+def _read_bson(stream):
+    while True:
+        head = stream.read(4)
+        if not head:
+            return
+        if len(head) < 4:
+            raise ValueError("Truncated BSON file")
+        size, = struct.unpack("<i", head)
+        data = head + stream.read(size - 4)
+        if len(data) < size:
+            raise ValueError("Truncated BSON file")
+        yield BSON(data).decode()
+
+
+def _read(path, format):
+    if format == BSON_FORMAT:
+        with open(path, "rb") as stream:
+            yield from _read_bson(stream)
+    else:
+        with open(path, encoding="utf-8") as stream:
+            for line in stream:
+                if line.strip():
+                    yield json_util.loads(line)
+
+
+def export_to(modelcls, path, format=None, query=None,
+              batch_size=DUMP_BATCH_SIZE, progress=None):
+    """Writes the documents that match `query` to `path`. They are read
+    raw, `batch_size` at a time."""
+    format = _format(path, format)
+    start = time.perf_counter()
+    count = 0
+    cursor = modelcls.find(query or {}).batch_size(batch_size).raw()
+    if format == BSON_FORMAT:
+        stream, encode = open(path, "wb"), BSON.encode
+    else:
+        stream = open(path, "w", encoding="utf-8")
+        encode = lambda doc: json_util.dumps(doc) + "\n"
+    with stream:
+        for doc in cursor:
+            stream.write(encode(doc))
+            count += 1
+            if progress and count % batch_size == 0:
+                progress(count, time.perf_counter() - start)
+    return _stats(count, start)
+
+
+def _validate(modelcls, doc):
+    """The document to insert for `doc`, after Field.validate() and the
+    checks of the fields. The model is built as a loaded one, so the
+    values are checked as the values of a stored model."""
+    model = modelcls._from_db(doc)
+    for name, field in modelcls._fields.items():
+        if isinstance(field, mago.field.Field) and name in model:
+            value = field.validate(model, dict.get(model, name))
+            dict.__setitem__(model, name, value)
+    model._check_attrs()
+    return model._store()
+
+
+def import_from(modelcls, path, format=None, batch_size=DUMP_BATCH_SIZE,
+                validate=True, progress=None):
+    """Inserts the documents of `path` with unordered bulk writes of
+    `batch_size` documents. With `validate`, every document goes through
+    the model fields and checks, and a FieldError stops the import (the
+    previous batches are already written)."""
+    format = _format(path, format)
+    coll = modelcls.collection()
+    start = time.perf_counter()
+    count = 0
+    batch = []
+
+    def _flush():
+        mago.session.bulk_write(coll, batch, ordered=False,
+                                batch_size=batch_size)
+        del batch[:]
+        if progress:
+            progress(count, time.perf_counter() - start)
+
+    for doc in _read(path, format):
+        if validate:
+            doc = _validate(modelcls, doc)
+        batch.append(("insert", None, doc))
+        count += 1
+        if len(batch) >= batch_size:
+            _flush()
+    if batch:
+        _flush()
+    return _stats(count, start)
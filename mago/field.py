@@ -1,5 +1,5 @@
 """ The basic field attributes. """
-from collections import Callable
+from collections.abc import Callable
 from bson.dbref import DBRef
 from bson.objectid import ObjectId
 import mago
@@ -10,11 +10,25 @@ class FieldError(Exception):
     pass
 
 
+def _load(modelcls, oid, session):
+    """Returns the model with id `oid`, from the session if it's there."""
+    if session:
+        model = session._lookup(modelcls, oid)
+        if model is not None:
+            return model
+    return modelcls.find_one({"_id": oid}, session=session)
+
+
 class AbstractField(object):
     pass
 
 
-class Field(object):
+class AbstractRelation(AbstractField):
+    """Base for the fields that link models between them."""
+    pass
+
+
+class Field(AbstractField):
     """This class may eventually do type-checking, default values,
     etc. but for right now it's for subclassing and glorified
     documentation.
@@ -30,6 +44,8 @@ class Field(object):
     def __init__(self, value_type=None, **kwargs):
         self.value_type = value_type
         self.required = kwargs.get("required", False)
+        self.unique = kwargs.get("unique", False)
+        self.index = kwargs.get("index", self.unique)
         self._default = kwargs.get("default", mago.UnSet)
         self.field_name = None
 
@@ -45,14 +61,26 @@ class Field(object):
             raise FieldError("'{}' is required but empty.".format(
                 self.field_name))
 
-    def __set__(self, obj, val):
+    def validate(self, obj, val):
+        """The value stored for `val` in `obj`, after the type check and
+        the set callback. Raises FieldError for invalid values."""
         if self.value_type and not isinstance(val, self.value_type):
             raise FieldError("Invalid type: {} instead of {}".format(
                 type(val), self.value_type))
 
         if self._set_callback:
             val = self._set_callback(obj, val)
+        return val
+
+    def __set__(self, obj, val):
+        val = self.validate(obj, val)
+        old = dict.get(obj, self.field_name, mago.UnSet)
         dict.__setitem__(obj, self.field_name, val)
+        obj._track_change(self.field_name, old)
+
+    def __delete__(self, obj):
+        old = dict.pop(obj, self.field_name, mago.UnSet)
+        obj._track_change(self.field_name, old)
 
     def __get__(self, obj, objtype):
         # print("Field.__get__  con ", obj)
@@ -72,19 +100,102 @@ class ReferenceField(Field):
         super(ReferenceField, self).__init__(model, **kwargs)
         self.model = model
 
+    def __set__(self, obj, val):
+        if isinstance(val, DBRef):
+            # raw value, i.e. loaded from the db
+            obj._refs.pop(self.field_name, None)
+            old = dict.get(obj, self.field_name, mago.UnSet)
+            dict.__setitem__(obj, self.field_name, val)
+            obj._track_change(self.field_name, old)
+            return
+        super(ReferenceField, self).__set__(obj, val)
+
+    def validate(self, obj, val):
+        if isinstance(val, DBRef):
+            # raw value, i.e. loaded from the db
+            return val
+        return super(ReferenceField, self).validate(obj, val)
+
     def _set_callback(self, instance, value):
         """ Resolves a Model to a DBRef """
+        instance._refs.pop(self.field_name, None)
         if value:
-            value = DBRef(self.model._get_name(), value.id)
+            value = DBRef(self.model.collection_name(), value.id)
         return value
 
-    def _get_callback(self, instance, value):
+    def _get_callback(self, instance, objtype):
         """ Retrieves the id, then retrieves the model from the db """
+        value = instance.get(self.field_name, mago.UnSet)
         if value:
             # Should be a DBRef
-            return self.model.find_one({"_id": value.id})
+            if self.field_name not in instance._refs:
+                instance._refs[self.field_name] = \
+                  _load(self.model, value.id, instance._session)
+            return instance._refs[self.field_name]
         return value
 
+    def __delete__(self, obj):
+        obj._refs.pop(self.field_name, None)
+        super(ReferenceField, self).__delete__(obj)
+
+
+def prefetch_references(models, paths, session=None):
+    """Resolves the ReferenceFields named in `paths` for every model in
+    `models` and attaches the results to each instance. Dotted paths are
+    resolved level by level, with one `$in` query per target collection
+    and level."""
+    tree = {}
+    for path in paths:
+        node = tree
+        for name in path.split("."):
+            node = node.setdefault(name, {})
+
+    def _prefetch(models, tree):
+        for name, subtree in tree.items():
+            wanted = {}                   # coll => set(ids)
+            for model in models:
+                field = model._fields.get(name)
+                if not isinstance(field, ReferenceField):
+                    raise FieldError("'{}' is not a ReferenceField of {}"
+                                     .format(name, model.collection_name()))
+                ref = dict.get(model, name)
+                if isinstance(ref, DBRef):
+                    wanted.setdefault(ref.collection, set()).add(ref.id)
+
+            resolved = {}                 # (coll, id) => model
+            for coll, ids in wanted.items():
+                modelcls = mago.types.models[coll]
+                if session:
+                    for oid in list(ids):
+                        model = session._lookup(modelcls, oid)
+                        if model is not None:
+                            resolved[(coll, oid)] = model
+                            ids.discard(oid)
+                if not ids:
+                    continue
+                spec = {"_id": {"$in": list(ids)}}
+                collection = modelcls.collection()
+                with mago.monitoring.watch(
+                        modelcls, "find",
+                        mago.monitoring.explainer(collection, spec),
+                        filter=spec) as event:
+                    for doc in collection.find(spec):
+                        resolved[(coll, doc["_id"])] = \
+                          mago.cursor.cast(modelcls, session, doc)
+                        event.count += 1
+
+            for model in models:
+                ref = dict.get(model, name)
+                if isinstance(ref, DBRef):
+                    model._refs[name] = resolved.get((ref.collection, ref.id))
+
+            if subtree and resolved:
+                _prefetch(list(resolved.values()), subtree)
+
+    if models:
+        _prefetch(models, tree)
+    return models
+
 
 class ConstantField(Field):
     """ Doesn't let you change the value after setting it. """
@@ -101,6 +212,7 @@ class ConstantField(Field):
     def __delete__(self, obj):
         if obj.id:
             raise FieldError("Can not delete a constant field after saving.")
+        super(ConstantField, self).__delete__(obj)
 
 
 class EnumField(Field):
@@ -126,33 +238,262 @@ class EnumField(Field):
         return val
 
 
-class RelationList(list):
+# children read per round trip when iterating a relation
+RELATION_BATCH_SIZE = 100
 
-    def __init__(self, model, backref, obj, iter_):
-        # super(RelationList, self).__init__()
-        list.__init__(self)
-        # print(dir(super(RelationList, self)))
 
-        self._model = model
-        self._backref = backref
+class RelationView(object):
+    """The children of a OneToMany. Nothing is read until it's used: len()
+    is a count, slices are skip/limit queries and iteration reads the
+    children in batches. filter() and order() return narrowed views.
+
+    Children appended in memory are kept aside until the view is loaded,
+    load() reads every child and keeps them in memory."""
+
+    def __init__(self, obj, relation, spec=None, sort=None):
         self._obj = obj
-        self.extend(iter_)
+        self._relation = relation
+        self._spec = spec or {}
+        self._sort = sort or []
+        self._loaded = None             # [model] once loaded
+        self._added = []                # appended while not loaded
+
+    @property
+    def _backref(self):
+        return self._relation._backref
+
+    def _spec_all(self):
+        spec = dict(self._spec)
+        spec[self._backref] = self._obj.id
+        return spec
+
+    def _cursor(self, exclude=()):
+        spec = self._spec_all()
+        if exclude:
+            spec["_id"] = {"$nin": [model.id for model in exclude]}
+        cursor = self._relation.model.find(spec, session=self._obj._session)
+        if self._sort:
+            cursor.sort(self._sort)
+        return cursor.batch_size(RELATION_BATCH_SIZE)
+
+    def _wake(self, model):
+        # the parent is already known
+        if self._backref not in model._refs:
+            model._refs[self._backref] = self._obj
+        return model
+
+    def load(self):
+        """Reads every child, from now on the view works in memory"""
+        if self._loaded is None:
+            self._loaded = [self._wake(model) for model in
+                            self._cursor(self._added)] + self._added
+            self._added = []
+        return self
+
+    def filter(self, spec):
+        """A view of the children that match `spec`"""
+        return RelationView(self._obj, self._relation,
+                            dict(self._spec, **spec), self._sort)
+
+    def order(self, **kwargs):
+        """A view ordered by one field = mago.ASC or mago.DESC"""
+        if len(kwargs) != 1:
+            raise ValueError("order() requires one field = ASC or DESC.")
+        if list(kwargs.values())[0] not in (mago.ASC, mago.DESC):
+            raise TypeError("Order value must be mago.ASC or mago.DESC.")
+        return RelationView(self._obj, self._relation, self._spec,
+                            self._sort + list(kwargs.items()))
+
+    def __len__(self):
+        if self._loaded is not None:
+            return len(self._loaded)
+        return self._cursor(self._added).count() + len(self._added)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        if self._loaded is not None:
+            return iter(list(self._loaded))
+        return self._iter()
+
+    def _iter(self):
+        for model in self._cursor(self._added):
+            yield self._wake(model)
+        yield from list(self._added)
+
+    def _window(self, start, stop, stored):
+        """The children in [start, stop), the `stored` ones come first and
+        are read with one skip/limit query"""
+        res = []
+        if start < stored:
+            cursor = self._cursor(self._added).skip(start)\
+              .limit(min(stop, stored) - start)
+            res = [self._wake(model) for model in cursor]
+        return res + self._added[max(start - stored, 0):
+                                 max(stop - stored, 0)]
+
+    def __getitem__(self, index):
+        if self._loaded is not None:
+            return self._loaded[index]
+        if not isinstance(index, slice) and index >= 0 and not self._added:
+            # no count needed
+            res = self._window(index, index + 1, index + 1)
+            if not res:
+                raise IndexError("relation index out of range")
+            return res[0]
+
+        stored = self._cursor(self._added).count()
+        total = stored + len(self._added)
+        if isinstance(index, slice):
+            indexes = range(*index.indices(total))
+            if not indexes:
+                return []
+            start = min(indexes)
+            window = self._window(start, max(indexes) + 1, stored)
+            return [window[i - start] for i in indexes if i - start <
+                    len(window)]
+        if index < 0:
+            index += total
+        if not 0 <= index < total:
+            raise IndexError("relation index out of range")
+        res = self._window(index, index + 1, stored)
+        if not res:
+            raise IndexError("relation index out of range")
+        return res[0]
+
+    def __eq__(self, other):
+        if isinstance(other, (list, RelationView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        if self._loaded is not None:
+            return repr(self._loaded)
+        return "<RelationView {}.{} of {}>".format(
+            self._relation.model.collection_name(), self._backref,
+            self._obj.id)
+
+    def _link(self, model):
+        dict.__setitem__(model, self._backref, self._obj.id)
+        model._refs[self._backref] = self._obj
+
+    def _unlink(self, model):
+        dict.pop(model, self._backref, None)
+        model._refs.pop(self._backref, None)
+
+    def append(self, model):
+        self.extend([model])
+
+    def extend(self, models):
+        """Adds children in memory, they are written when saved"""
+        members = self._added if self._loaded is None else self._loaded
+        known = {member.id for member in members}
+        for model in models:
+            old = dict.get(model, self._backref, mago.UnSet)
+            self._link(model)
+            model._track_change(self._backref, old)
+            if model.id not in known:
+                known.add(model.id)
+                members.append(model)
+
+    def discard(self, model):
+        """Forgets `model`, its backref is left as it is"""
+        for models in (self._loaded, self._added):
+            if models and model in models:
+                models.remove(model)
+
+    def _member_ids(self):
+        if self._loaded is not None:
+            return {model.id for model in self._loaded}
+        ids = {doc["_id"] for doc in mago.monitoring.find(
+            self._relation.model.collection(), self._spec_all(), {"_id": 1},
+            self._relation.model)}
+        ids.update(model.id for model in self._added)
+        return ids
+
+    def _update(self, spec, update):
+        """One update_many, queued if the parent is in a session"""
+        coll = self._relation.model.collection()
+        session = self._obj._session
+        if session and session.is_active:
+            session.add_operation(coll.update, spec, update, multi=True)
+        else:
+            coll.update(spec, update, multi=True)
+
+    def _keep_state(self, models=()):
+        """In a session, the children and their backrefs are restored if
+        the queued writes are rolled back"""
+        session = self._obj._session
+        if not (session and session.is_active):
+            return
+        backref = self._backref
+        children = {id(model): model for model in
+                    (self._loaded or []) + self._added + list(models)}
+        saved = [(child, dict.get(child, backref, mago.UnSet),
+                  child._refs.get(backref, mago.UnSet))
+                 for child in children.values()]
+        session.add_rollback(self._restore, None if self._loaded is None
+                             else list(self._loaded), list(self._added), saved)
+
+    def _restore(self, loaded, added, saved):
+        self._loaded = loaded
+        self._added = added
+        for child, value, ref in saved:
+            if value is mago.UnSet:
+                dict.pop(child, self._backref, None)
+            else:
+                dict.__setitem__(child, self._backref, value)
+            if ref is mago.UnSet:
+                child._refs.pop(self._backref, None)
+            else:
+                child._refs[self._backref] = ref
+
+    def set(self, models):
+        """Makes `models` the children. Only the membership changes are
+        written, with one update for the added children and another one
+        for the removed ones."""
+        new = {}
+        for model in models:
+            new.setdefault(model.id, model)
+        self._keep_state(new.values())
+        current = self._member_ids()
+        added = [oid for oid in new if oid not in current]
+        removed = [oid for oid in current if oid not in new]
+        if added:
+            self._update({"_id": {"$in": added}},
+                         {"$set": {self._backref: self._obj.id}})
+        if removed:
+            self._update({"_id": {"$in": removed},
+                          self._backref: self._obj.id},
+                         {"$unset": {self._backref: ""}})
+
+        for model in (self._loaded or []) + self._added:
+            if model.id not in new:
+                self._unlink(model)
+        for model in new.values():
+            self._link(model)
+        self._loaded = list(new.values())
+        self._added = []
 
     def clear(self):
-        """delete every reference from model and clear the list"""
-        # TODO: delete references
-        # super(RelationList, ).clear(self)
-        for model in self:
-            dict.__setitem__(model, self._backref, None)
-        del self[:]
+        """Removes every child with one update"""
+        self._keep_state()
+        self._update(self._spec_all(), {"$unset": {self._backref: ""}})
+        for model in (self._loaded or []) + self._added:
+            self._unlink(model)
+        self._loaded = []
+        self._added = []
 
-    def extend(self, other):
-        for model in other:
-            dict.__setitem__(model, self._backref, self._obj)
-        # super(RelationList, ).extend(other)
-        list.extend(self, other)
 
-class OneToMany(AbstractField):
+def _discard(parent, backref, child):
+    """Removes `child` from the relation of `parent`, if it was read"""
+    view = parent._views.get(backref)
+    if view is not None:
+        view.discard(child)
+
+
+class OneToMany(AbstractRelation):
 
     @property
     def model(self):
@@ -165,32 +506,26 @@ class OneToMany(AbstractField):
         self._backref = backref
 
     def __set__(self, obj, val):
-        """Done"""
-        current = getattr(obj, self.field_name)
-        current.clear()
-        current.extend(val)
+        """Only the difference with the current children is written"""
+        self.__get__(obj, None).set(val)
 
     def __get__(self, obj, objtype):
-        """Done"""
+        """The RelationView of the children, it lives in `obj._views`, apart
+        from the resolved references, so the children appended and not
+        saved yet survive refresh_refs() and rollbacks"""
         if obj is None:
             return self
-        res = dict.get(obj, self.field_name, None)
+        res = obj._views.get(self.field_name)
         if res is None:
-            res = RelationList(self.model, self._backref,
-                    obj, list(self.model.collection().find({
-                        self._backref : obj.id
-                    })))
-            dict.__setitem__(obj, self.field_name, res)
-
+            res = obj._views[self.field_name] = RelationView(obj, self)
         return res
 
     def __delete__(self, obj):
         """Done"""
-        current = getattr(obj, self.field_name)
-        current.clear()
+        self.__get__(obj, None).clear()
 
 
-class ManyToOne(AbstractField):
+class ManyToOne(AbstractRelation):
 
     @property
     def model(self):
@@ -202,13 +537,24 @@ class ManyToOne(AbstractField):
         self._backref = backref
 
     def __set__(self, obj, val):
-        """Done"""
-        old = dict.get(obj, self.field_name, None)
+        """Only the id is stored in the document, the model itself is
+        cached in `obj._refs`."""
+        stored = dict.get(obj, self.field_name, mago.UnSet)
+        if isinstance(val, ObjectId):
+            # raw value, i.e. loaded from the db
+            obj._refs.pop(self.field_name, None)
+            dict.__setitem__(obj, self.field_name, val)
+            obj._track_change(self.field_name, stored)
+            return
+        old = self.__get__(obj, None)
         if old:
-            dict.pop(old, self._backref)
-        ref = val[self._backref]
-        dict.__setitem__(obj, self.field_name, val)
-        ref.append(obj)
+            _discard(old, self._backref, obj)
+        obj._refs[self.field_name] = val
+        dict.__setitem__(obj, self.field_name,
+                         None if val is None else val.id)
+        obj._track_change(self.field_name, stored)
+        if val is not None:
+            val[self._backref].append(obj)
 
     def __get__(self, obj, objtype):
         """Done"""
@@ -217,45 +563,227 @@ class ManyToOne(AbstractField):
 
         res = dict.get(obj, self.field_name, None)
         if isinstance(res, ObjectId): # wake-up!
-            res = self.model.find_one({"_id": res})
-            dict.__setitem__(obj, self.field_name, res)
+            if self.field_name not in obj._refs:
+                obj._refs[self.field_name] = _load(self.model, res,
+                                                   obj._session)
+            res = obj._refs[self.field_name]
 
         return res
 
 
     def __delete__(self, obj):
-        old = dict.get(obj, self.field_name, None)
+        old = self.__get__(obj, None)
         if old:
-            dict.pop(old, self._backref)
-        dict.pop(obj, self.field_name)
+            _discard(old, self._backref, obj)
+        obj._refs.pop(self.field_name, None)
+        stored = dict.pop(obj, self.field_name, mago.UnSet)
+        obj._track_change(self.field_name, stored)
 
 
-class ManyToMany(object):
-    _relations = []
+class EdgeView(object):
+    """The models related to `obj` through a ManyToMany. Edges are read by
+    `from` (the compound index): len() is a count, slices page the edges
+    and iteration resolves them in batches, one `$in` query per batch.
 
-    def __init__(self, name, modelcls, bidirectional=True):
-        if name in ManyToMany._relations:
-            raise ValueError("Relation name '{}' already extists".format(name))
-        self._bi = bidirectional
-        self._coll = mago.connection.Connection()\
-          .get_collection(modelcls.__name__)
+    add(), remove() and set() write the edges with bulk operations, they
+    are queued if `obj` is in a session."""
 
-    def __set__(self, obj, val):
-        raise NotImplemented("Not implemented yet")
+    def __init__(self, obj, relation):
+        self._obj = obj
+        self._relation = relation
+        self._queue = None              # the changes queued in a session
 
-    def __get__(self, obj, objtype):
-        res = None
-        if self._bi:
-            res = RelationCursor({"$or" : [{ "from": obj.id}, {"to": obj.id}]})
+    @property
+    def _coll(self):
+        return self._relation._collection(self._obj.__class__)
+
+    def _queued(self):
+        """{added, removed, cleared} queued in the active session of
+        `obj`, they are forgotten once the session is flushed or rolled
+        back (its list of operations is replaced)"""
+        session = self._obj._session
+        if not (session and session.is_active):
+            self._queue = None
+            return None
+        if self._queue is None or \
+           self._queue["operations"] is not session._operations:
+            self._queue = {"operations": session._operations,
+                           "added": set(), "removed": set(),
+                           "cleared": False}
+        return self._queue
+
+    def _cursor(self):
+        cursor = RelationCursor(self._obj, self._relation.model, self._coll,
+                                {"from": self._obj.id})
+        return cursor.sort("to", mago.ASC).batch_size(RELATION_BATCH_SIZE)
+
+    def __iter__(self):
+        return self._cursor()
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        return self.count() > 0
+
+    def count(self):
+        return mago.monitoring.count(self._coll, {"from": self._obj.id})
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if start >= stop:
+                return []
+            return list(self._cursor()[start:stop])[::step]
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError("relation index out of range")
+        return self._cursor()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (list, EdgeView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return "<EdgeView {} of {}>".format(self._relation._name,
+                                            self._obj.id)
+
+    def ids(self):
+        """The related ids, read from the index"""
+        return [edge["to"] for edge in mago.monitoring.find(
+            self._coll, {"from": self._obj.id}, {"to": 1, "_id": 0})]
+
+    def _write(self, func, *args, **kwargs):
+        session = self._obj._session
+        if session and session.is_active:
+            session.add_operation(func, *args, **kwargs)
         else:
-            res = RelationCursor({"from": obj.id})
-        dict.__setitem__(obj, self.field_name, res)
+            func(*args, **kwargs)
+
+    def _edges(self, ids):
+        """The (from, to) pairs that link `obj` with `ids`"""
+        pairs = [(self._obj.id, oid) for oid in ids]
+        if self._relation._bi:
+            pairs.extend((oid, self._obj.id) for oid in ids
+                         if oid != self._obj.id)
+        return pairs
+
+    def _add_ids(self, ids):
+        # upserts, adding an existing edge is a no-op
+        ops = [("replace", {"from": src, "to": dst}, {"from": src, "to": dst})
+               for src, dst in self._edges(ids)]
+        queue = self._queued()
+        if queue is not None:
+            queue["added"].update(ids)
+            queue["removed"].difference_update(ids)
+        if ops:
+            self._write(mago.session.bulk_write, self._coll, ops,
+                        ordered=False)
+
+    def _remove_ids(self, ids):
+        if not ids:
+            return
+        queue = self._queued()
+        if queue is not None:
+            queue["removed"].update(ids)
+            queue["added"].difference_update(ids)
+        self._write(self._coll.remove,
+                    {"from": self._obj.id, "to": {"$in": ids}})
+        if self._relation._bi:
+            self._write(self._coll.remove,
+                        {"from": {"$in": ids}, "to": self._obj.id})
+
+    def add(self, *models):
+        self._add_ids([model.id for model in models])
+
+    def append(self, model):
+        self.add(model)
+
+    def extend(self, models):
+        self.add(*models)
+
+    def remove(self, *models):
+        self._remove_ids([model.id for model in models])
+
+    def set(self, models):
+        """Makes `models` the related models, only the missing and the
+        extra edges are written"""
+        new = []
+        for model in models:
+            if model.id not in new:
+                new.append(model.id)
+        current = self._current_ids()
+        self._add_ids([oid for oid in new if oid not in current])
+        new = set(new)
+        self._remove_ids([oid for oid in current if oid not in new])
+
+    def _current_ids(self):
+        """The related ids, including the changes queued in a session"""
+        queue = self._queued()
+        if queue is None:
+            return set(self.ids())
+        current = set() if queue["cleared"] else set(self.ids())
+        return (current | queue["added"]) - queue["removed"]
 
+    def clear(self):
+        queue = self._queued()
+        if queue is not None:
+            queue.update(added=set(), removed=set(), cleared=True)
+        self._write(self._coll.remove, {"from": self._obj.id})
+        if self._relation._bi:
+            self._write(self._coll.remove, {"to": self._obj.id})
 
-    def __delete__(self, obj):
-        raise NotImplemented("Not implemented yet")
 
+class ManyToMany(AbstractRelation):
+    """Models related through an edge collection named `name`, with one
+    document per edge: _id | from | to. Bidirectional relations store the
+    edges in both directions, so the related models can declare the same
+    relation back to the owner."""
+    _relations = {}                       # name => bidirectional
 
+    @property
+    def model(self):
+        """Return related model class"""
+        return mago.types.models[self._model]
 
-#
-# _id | from | to
+    def __init__(self, name, model, bidirectional=True):
+        if name in ManyToMany._relations and not \
+           (bidirectional and ManyToMany._relations[name]):
+            raise ValueError("Relation name '{}' already extists".format(name))
+        ManyToMany._relations[name] = bidirectional
+        self.field_name = None
+        self._name = name
+        if not isinstance(model, str):
+            model = model.__name__
+        self._model = model.lower()
+        self._bi = bidirectional
+        self._colls = {}                # alias => (connection, collection)
+
+    def _collection(self, owner):
+        """The edge collection, in the connection of the `owner` model.
+        It's resolved once per connection."""
+        alias = owner._db_alias
+        connection = mago.connection.Connection().get_connection(alias)
+        cached = self._colls.get(alias)
+        if cached is None or cached[0] is not connection:
+            cached = self._colls[alias] = (
+                connection, mago.connection.Connection().get_collection(
+                    self._name, alias=alias))
+        return cached[1]
+
+    def __set__(self, obj, val):
+        self.__get__(obj, None).set(val)
+
+    def __get__(self, obj, objtype):
+        """The EdgeView, it lives in `obj._views`"""
+        if obj is None:
+            return self
+        res = obj._views.get(self.field_name)
+        if res is None:
+            res = obj._views[self.field_name] = EdgeView(obj, self)
+        return res
+
+    def __delete__(self, obj):
+        self.__get__(obj, None).clear()
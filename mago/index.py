@@ -0,0 +1,150 @@
+"""Index declarations. Indexes are declared on the fields, in the model Meta
+and implicitly by the relations, then created with sync_indexes():
+
+    class User(mago.Model):
+        email = mago.Field(str, unique=True)
+        name = mago.Field(index=True)
+
+        class Meta:
+            indexes = [
+                [("name", mago.ASC), ("created", mago.DESC)],
+                {"keys": ["country", "city"], "sparse": True},
+            ]
+
+    mago.sync_indexes()
+"""
+from pymongo import ASCENDING as ASC
+import mago
+import mago.connection
+import mago.field
+import mago.types
+
+
+_extra = {}                                # collection => [Index]
+
+
+class Index(object):
+    """The keys, as [(name, direction)], and the create_index() options of
+    an index. Field names alone mean ascending keys."""
+
+    def __init__(self, keys, **options):
+        if isinstance(keys, str):
+            keys = [keys]
+        self.keys = [(key, ASC) if isinstance(key, str) else tuple(key)
+                     for key in keys]
+        self.options = options
+
+    @classmethod
+    def parse(cls, value):
+        """Builds an Index from a Meta.indexes entry"""
+        if isinstance(value, Index):
+            return value
+        if isinstance(value, dict):
+            options = dict(value)
+            return cls(options.pop("keys"), **options)
+        return cls(value)
+
+    @property
+    def key(self):
+        return tuple(self.keys)
+
+    def __repr__(self):
+        return "Index({!r}, **{!r})".format(self.keys, self.options)
+
+
+# the indexes of the ManyToMany edge collections
+EDGE_INDEXES = (Index(["from", "to"], unique=True), Index(["to", "from"]))
+
+
+def declare(collection, *indexes):
+    """Declares indexes on a collection without model. They are created
+    in the default connection, or with the model for its subcollections
+    ("model.sub")."""
+    _extra.setdefault(collection, []).extend(indexes)
+
+
+def _add(declared, collection, index):
+    indexes = declared.setdefault(collection, {})
+    current = indexes.get(index.key)
+    # the most restrictive declaration wins
+    if current is None or index.options.get("unique") and \
+       not current.options.get("unique"):
+        indexes[index.key] = index
+
+
+def _declared(models):
+    """The declared indexes, and {collection: (owner, ManyToMany)} for the
+    edge collections"""
+    declared = {}
+    edges = {}
+    for model in models or list(mago.types.models.values()):
+        name = model.collection_name()
+        for field in model._fields.values():
+            if isinstance(field, mago.field.Field) and field.index:
+                _add(declared, name, Index(field.field_name,
+                                           unique=field.unique))
+            elif isinstance(field, mago.field.ManyToOne):
+                _add(declared, name, Index(field.field_name))
+            elif isinstance(field, mago.field.OneToMany):
+                _add(declared, field._model, Index(field._backref))
+            elif isinstance(field, mago.field.ManyToMany):
+                for index in EDGE_INDEXES:
+                    _add(declared, field._name, index)
+                edges.setdefault(field._name, (model, field))
+        for value in model._indexes:
+            _add(declared, name, Index.parse(value))
+    names = {model.collection_name() for model in models or ()}
+    for collection, indexes in _extra.items():
+        if models and collection.partition(".")[0] not in names:
+            continue
+        for index in indexes:
+            _add(declared, collection, index)
+    return declared, edges
+
+
+def declared_indexes(models=None):
+    """{collection: {key: Index}} for `models` (all of them by default),
+    including the backrefs and edges of their relations and their
+    subcollections."""
+    return _declared(models)[0]
+
+
+def _collection(name, edges):
+    if name in edges:
+        owner, field = edges[name]
+        return field._collection(owner)
+    model = mago.types.models.get(name)
+    if model is not None:
+        return model.collection()
+    parent, _, sub = name.partition(".")
+    model = mago.types.models.get(parent)
+    if sub and model is not None:
+        return model.collection()[sub]
+    return mago.connection.Connection().get_collection(name)
+
+
+def _existing(coll):
+    keys = set()
+    for info in coll.index_information().values():
+        keys.add(tuple((key, int(direction))
+                       if isinstance(direction, (int, float))
+                       else (key, direction)
+                       for key, direction in info["key"]))
+    return keys
+
+
+def sync_indexes(*models):
+    """Creates the declared indexes that are missing in the db, for `models`
+    or every model. Existing indexes are left alone. Returns the created
+    ones as [(collection, index name)]."""
+    created = []
+    declared, edges = _declared(models)
+    for name, indexes in declared.items():
+        coll = _collection(name, edges)
+        existing = _existing(coll)
+        for key, index in indexes.items():
+            if key in existing:
+                continue
+            created.append((name, coll.create_index(index.keys,
+                                                    **index.options)))
+    return created
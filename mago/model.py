@@ -2,44 +2,87 @@
 
 import mago
 import logging
-import pickle
 # import mago.connection
+import mago.aio
+import mago.codec
 import mago.cursor
 import mago.field
+import mago.monitoring
+import mago.traversal
 import mago.decorators
+import mago.dump
 import mago.types
 from bson.dbref import DBRef
 from bson.objectid import ObjectId
 
 
-def obj_to_dict(obj):
-    """Translate a non-model and non-native object to dict"""
-    if hasattr(obj, "to_dict"):
-        return obj.to_dict()
+def _each(value):
+    if isinstance(value, dict) and "$each" in value:
+        return value["$each"]
+    return [value]
 
-    res = {}
-    res["__class__"] = pickle.dumps(obj.__class__, 3)
-    for attr in obj.__dict__:
-        val = getattr(obj, attr)
-        if type(val) not in mago.types.NATIVE:
-            res[attr] = obj_to_dict(val)
-            res[attr]["__class__"] = pickle.dumps(val.__class__, 3)
-        else:
-            res[attr] = val
-    return res
+
+def _inc(current, value):
+    return (current or 0) + value
 
 
-def dict_to_obj(dic):
-    class_ = dic.pop("__class__")
-    res = pickle.loads(class_)()
+def _push(current, value):
+    return list(current or []) + _each(value)
 
-    for attr, val in dic.items():
-        if val.__class__ is dict and val.get("__class__"):
-            val = dict_to_obj(val)
-        setattr(res, attr, val)
+
+def _add_to_set(current, value):
+    res = list(current or [])
+    for item in _each(value):
+        if item not in res:
+            res.append(item)
     return res
 
 
+def _matches(item, value):
+    """$pull of a document removes the items that have its fields"""
+    if isinstance(value, dict):
+        return isinstance(item, dict) and \
+          all(key in item and item[key] == val for key, val in value.items())
+    return item == value
+
+
+def _pull(current, value):
+    return [item for item in current or [] if not _matches(item, value)]
+
+
+# atomic operator => how it is applied locally
+ATOMIC_OPS = {
+    "$inc": _inc,
+    "$push": _push,
+    "$addToSet": _add_to_set,
+    "$pull": _pull,
+}
+
+
+class ModelPlan(object):
+    """What has to be done with each field when a model is built, checked
+    or stored. It's computed once per model class, so these paths don't
+    need to inspect every field."""
+
+    def __init__(self, fields):
+        self.defaults = []                # [(name, field)]
+        self.setters = {}                 # name => field, needs __set__
+        self.checks = []                  # [(name, field)]
+        for name, field in sorted(fields.items()):
+            if not isinstance(field, mago.field.Field):
+                # relations
+                self.setters[name] = field
+                continue
+            if field._default is not mago.UnSet:
+                self.defaults.append((name, field))
+            if field.value_type or field._set_callback or \
+               type(field).__set__ is not mago.field.Field.__set__:
+                self.setters[name] = field
+            if field.required or \
+               type(field).check is not mago.field.Field.check:
+                self.checks.append((name, field))
+
+
 class NewModelClass(type):
     """ Metaclass for inheriting field lists """
     def __new__(cls, name, bases, attributes):
@@ -50,8 +93,13 @@ class NewModelClass(type):
             return new_model
 
         new_model._name = new_model.__name__.lower()
-        new_model._collection = mago.connection.Connection()\
-          .get_collection(new_model._name)
+        meta = getattr(new_model, "Meta", None)
+        new_model._db_alias = getattr(meta, "db_alias",
+                                      mago.connection.DEFAULT_ALIAS)
+        new_model._read_preference = getattr(meta, "read_preference", None)
+        new_model._indexes = list(getattr(meta, "indexes", ()))
+        # bound on first use, see Model.collection()
+        new_model._collection = None
 
         mago.types.models[new_model._name] = new_model
 
@@ -64,6 +112,7 @@ class NewModelClass(type):
 
             new_model._fields[attr] = value
             value.field_name = attr
+        new_model._plan = ModelPlan(new_model._fields)
         return new_model
 
 
@@ -85,12 +134,64 @@ class Entity(object):
             # Model.find({}, timeout=False)
             raise ValueError(
                 'find() requires a query when called with keyword arguments')
+        if cls._read_preference is not None:
+            kwargs.setdefault("read_preference", cls._read_preference)
         return mago.cursor.Cursor(cls, *args, **kwargs)
 
     @classmethod
-    def find_one(cls, where):
-        doc = cls.collection().find_one(where)
-        return cls(**doc) if doc else None
+    def find_one(cls, where, session=None, read_preference=None):
+        """`read_preference` routes this read (i.e. to a secondary), the
+        one in the model's Meta is used by default."""
+        if read_preference is None:
+            read_preference = cls._read_preference
+        explain = lambda: cls.collection().find(where).limit(1).explain()
+        with mago.monitoring.watch(cls, "find_one", explain,
+                                   filter=where) as event:
+            if read_preference is None:
+                doc = cls.collection().find_one(where)
+            elif mago.types.PYMONGO3:
+                doc = cls.collection().with_options(
+                    read_preference=read_preference).find_one(where)
+            else:
+                doc = cls.collection().find_one(
+                    where, read_preference=read_preference)
+            event.count = 1 if doc else 0
+        return mago.cursor.cast(cls, session, doc) if doc else None
+
+    @classmethod
+    def export_to(cls, path, format=None, query=None, **kwargs):
+        """Streams the documents to a JSON Lines or BSON file, see
+        mago.dump.export_to()"""
+        return mago.dump.export_to(cls, path, format, query, **kwargs)
+
+    @classmethod
+    def import_from(cls, path, format=None, **kwargs):
+        """Inserts the documents of a JSON Lines or BSON file, see
+        mago.dump.import_from()"""
+        return mago.dump.import_from(cls, path, format, **kwargs)
+
+    @classmethod
+    def traverse(cls, ids, session=None):
+        """Walks the relations from the models with ids `ids`, see
+        mago.traversal.Traversal"""
+        return mago.traversal.Traversal(cls, ids, session)
+
+    @classmethod
+    def afind(cls, *args, **kwargs):
+        """Async find(), to be used with `async for`"""
+        return mago.aio.AsyncCursor(cls, *args, **kwargs)
+
+    @classmethod
+    async def afind_one(cls, where, session=None, read_preference=None):
+        if read_preference is None:
+            read_preference = cls._read_preference
+        kwargs = {} if read_preference is None else \
+          {"read_preference": read_preference}
+        with mago.monitoring.watch(cls, "find_one", filter=where) as event:
+            doc = await mago.aio.get_driver(cls._db_alias).find_one(
+                cls.collection_name(), where, **kwargs)
+            event.count = 1 if doc else 0
+        return mago.cursor.cast(cls, session, doc) if doc else None
 
 class Model(dict, Entity, metaclass=NewModelClass):
     """Core class of the module. It is disigned to be inherited."""
@@ -98,6 +199,10 @@ class Model(dict, Entity, metaclass=NewModelClass):
     _name = None
     _collection = None
     _fields = None
+    _plan = None
+    _db_alias = None
+    _read_preference = None
+    _indexes = ()
 
     @property
     def fields(self):
@@ -114,6 +219,11 @@ class Model(dict, Entity, metaclass=NewModelClass):
 
     @classmethod
     def collection(cls):
+        """The pymongo collection, resolved on first use and cached until
+        the model's alias is connected again."""
+        if cls._collection is None:
+            cls._collection = mago.connection.Connection()\
+              .get_collection(cls._name, alias=cls._db_alias)
         return cls._collection
 
     def __init__(self, **kwargs):
@@ -124,54 +234,288 @@ class Model(dict, Entity, metaclass=NewModelClass):
         if self.__class__ is Model:
             raise TypeError("Cannot instance Model.")
 
-        self._session = None
-        self._state = None
-        for name, field in self._fields.items():
-            if hasattr(field, "default") and field.default is not mago.UnSet:
-                self[name] = field.default
-
-        for field, value in kwargs.items():
-            self[field] = value
+        self._init_state()
+        setters = self._plan.setters
+        for name, field in self._plan.defaults:
+            if name in setters:
+                field.__set__(self, field.default)
+            else:
+                dict.__setitem__(self, name, field.default)
+
+        for key, value in kwargs.items():
+            if value.__class__ is dict and mago.codec.TYPE_KEY in value:
+                value = mago.codec.decode(value)
+            field = setters.get(key)
+            if field is None:
+                dict.__setitem__(self, key, value)
+            else:
+                field.__set__(self, value)
+        self._changed.update(dict.keys(self))
 
         if not '_id' in self:
             dict.__setitem__(self,'_id', ObjectId())
         if not '_trans' in self:
             dict.__setitem__(self,'_trans', [])
 
+    def _init_state(self):
+        self._session = None
+        self._state = None
+        self._refs = {}                   # field => resolved reference
+        self._views = {}                  # field => RelationView
+        self._changed = set()             # fields set since load/save
+        self._deleted = set()             # fields deleted since load/save
+        self._projection = None           # fields read, if not all
+
+    @classmethod
+    def _from_db(cls, doc):
+        """Builds a clean model from a document read from the db. The
+        values are trusted: no defaults, validation, callbacks nor change
+        tracking are applied."""
+        model = dict.__new__(cls)
+        model._init_state()
+        dict.update(model, doc)
+        for key, val in doc.items():
+            if val.__class__ is dict and mago.codec.TYPE_KEY in val:
+                dict.__setitem__(model, key, mago.codec.decode(val))
+        if not '_trans' in model:
+            dict.__setitem__(model, '_trans', [])
+        return model
+
     def save(self, *args, **kwargs):
         """Saves the model in the database"""
         self._check_attrs()
-        store = self.copy()
-        for key, val in self.items():
-            if type(val) not in mago.types.NATIVE:
-                store[key] = obj_to_dict(val)
-
-        self.collection().save(store, *args, **kwargs)
+        with mago.monitoring.watch(self.__class__, "save",
+                                   filter={"_id": self.id}) as event:
+            self.collection().save(self._store(), *args, **kwargs)
+            event.count = 1
+        self._clear_changes()
         return self
 
     def sync(self):
-        """Update all the fields to the db"""
+        """Update the changed fields to the db. Nothing is sent if there
+        are no changes."""
         self._check_attrs()
-        doc = self.copy()
-        del doc["_id"]
-        return self.collection().update({'_id': self.id},
-                           {"$set": doc})
+        spec = self._update_spec()
+        if not spec:
+            return None
+        with mago.monitoring.watch(self.__class__, "sync",
+                                   filter={"_id": self.id}) as event:
+            res = self.collection().update({'_id': self.id}, spec)
+            event.count = 1
+        self._clear_changes()
+        return res
+
+    def mark_changed(self, *field_names):
+        """Flags fields modified in place (i.e. `model["tags"].append(x)`)
+        so that sync() sends them."""
+        self._changed.update(field_names)
+        self._deleted.difference_update(field_names)
+        if self._session and self._session.is_active:
+            for name in field_names:
+                self._session._register_change(self, name, mago.UnSet)
+
+    def _track_change(self, name, old):
+        """Records that `name` was assigned or deleted. Every explicit
+        assignment is recorded, even of the same (maybe mutated) object;
+        the session compares the value with its snapshot."""
+        if dict.__contains__(self, name):
+            self._deleted.discard(name)
+            self._changed.add(name)
+        elif old is not mago.UnSet:
+            self._changed.discard(name)
+            self._deleted.add(name)
+        else:
+            return
+        if self._session and self._session.is_active:
+            self._session._register_change(self, name, old)
+
+    def _clear_changes(self):
+        self._changed.clear()
+        self._deleted.clear()
+
+    def _store(self):
+        """The document as it is written in the db"""
+        if self._projection:
+            raise ValueError("{} was read with fields({}), it can only be "
+                             "written with sync()".format(
+                                 self, ", ".join(self._projection)))
+        store = self.copy()
+        native = mago.types.NATIVE_SET
+        for key, val in store.items():
+            if type(val) not in native:
+                store[key] = mago.codec.encode(val)
+        return store
+
+    def _update_spec(self):
+        """The minimal update sent by sync(), None if nothing changed"""
+        spec = {}
+        changed = self._changed - {"_id"}
+        if changed:
+            spec["$set"] = {}
+            for key in changed:
+                val = dict.get(self, key)
+                if type(val) not in mago.types.NATIVE:
+                    val = mago.codec.encode(val)
+                spec["$set"][key] = val
+        if self._deleted:
+            spec["$unset"] = dict.fromkeys(self._deleted, "")
+        return spec or None
 
     def delete(self):
         """Uses the id in the collection.remove method.
         Allows all the same arguments (except the spec/id)."""
         if not self.id:
             raise ValueError('Cannot delete an unsaved model.')
-        return self.collection().remove(self.id)
+        with mago.monitoring.watch(self.__class__, "delete",
+                                   filter={"_id": self.id}) as event:
+            res = self.collection().remove(self.id)
+            event.count = 1
+        return res
+
+    async def asave(self):
+        """Async save()"""
+        self._check_attrs()
+        with mago.monitoring.watch(self.__class__, "save",
+                                   filter={"_id": self.id}) as event:
+            await mago.aio.get_driver(self._db_alias).save(
+                self.collection_name(), self._store())
+            event.count = 1
+        self._clear_changes()
+        return self
+
+    async def async_sync(self):
+        """Async sync()"""
+        self._check_attrs()
+        spec = self._update_spec()
+        if not spec:
+            return None
+        with mago.monitoring.watch(self.__class__, "sync",
+                                   filter={"_id": self.id}) as event:
+            res = await mago.aio.get_driver(self._db_alias).update(
+                self.collection_name(), {'_id': self.id}, spec)
+            event.count = 1
+        self._clear_changes()
+        return res
+
+    async def adelete(self):
+        """Async delete()"""
+        if not self.id:
+            raise ValueError('Cannot delete an unsaved model.')
+        with mago.monitoring.watch(self.__class__, "delete",
+                                   filter={"_id": self.id}) as event:
+            res = await mago.aio.get_driver(self._db_alias).remove(
+                self.collection_name(), {'_id': self.id})
+            event.count = 1
+        return res
 
     def get_ref(self):
         """ Returns a DBRef for an document. """
         return DBRef(self.collection_name(), self.id)
 
+    def refresh_refs(self, *field_names):
+        """Forgets the resolved references (all of them if no field is
+        given), so they are fetched again on the next access."""
+        if not field_names:
+            self._refs.clear()
+        for field_name in field_names:
+            self._refs.pop(field_name, None)
+
+    def _check_atomic(self, oper, name, value):
+        """Ensures that `oper` can be applied to the field `name`"""
+        if name == "_id":
+            raise mago.field.FieldError("You cannot update a model's `id`")
+        field = self._fields.get(name)
+        if field is not None and (not isinstance(field, mago.field.Field)
+                                  or field._set_callback):
+            raise mago.field.FieldError(
+                "'{}' cannot be updated atomically".format(name))
+
+        value_type = field.value_type if field is not None else None
+        current = self.get(name, None)
+        if oper == "$inc":
+            types, expected = (int, float), "a number"
+            if type(value) is bool or not isinstance(value, types):
+                raise mago.field.FieldError(
+                    "$inc requires a number, not {}".format(type(value)))
+        else:
+            types, expected = (list, tuple), "an array"
+            # only what is mirrored locally is accepted
+            if isinstance(value, dict) and oper == "$pull":
+                modifiers = [key for key in value
+                             if key.startswith("$") or "." in key]
+            elif isinstance(value, dict) and "$each" in value:
+                modifiers = [key for key in value if key != "$each"]
+            else:
+                modifiers = []
+            if modifiers:
+                raise mago.field.FieldError(
+                    "{} of '{}' does not support {}".format(
+                        oper, name, ", ".join(sorted(modifiers))))
+        if (value_type and not issubclass(value_type, types)) or \
+           (current is not None and not isinstance(current, types)):
+            raise mago.field.FieldError("'{}' is not {}".format(
+                name, expected))
+
+    def update_ops(self, ops):
+        """Applies atomic update operators, i.e.
+        {"$inc": {"hits": 1}, "$push": {"tags": "new"}}, in the db without
+        reading the document, and mirrors them in the model. Within a
+        session, the update is queued until the session is flushed."""
+        for oper, fields in ops.items():
+            if oper not in ATOMIC_OPS:
+                raise ValueError("Unsupported operator: {}".format(oper))
+            for name, value in fields.items():
+                self._check_atomic(oper, name, value)
+
+        # the values after the update, checked before anything is sent
+        values = {}
+        for oper, fields in ops.items():
+            for name, value in fields.items():
+                current = values.get(name, self.get(name, mago.UnSet))
+                values[name] = ATOMIC_OPS[oper](current, value)
+                field = self._fields.get(name)
+                if field is not None and field.value_type and \
+                   not isinstance(values[name], field.value_type):
+                    raise mago.field.FieldError(
+                        "'{}' would not be of type {}".format(
+                            name, field.value_type.__name__))
+
+        session = self._session if self._session and \
+          self._session.is_active else None
+        res = None
+        if not session:
+            res = self.collection().update({"_id": self.id}, ops)
+        for name, value in values.items():
+            old = self.get(name, mago.UnSet)
+            dict.__setitem__(self, name, value)
+            if session:
+                session._register_change(self, name, old)
+
+        if session and self._state is not mago.Session.NEW:
+            # new models are inserted with the values already applied
+            session._register_update(self, ops)
+        return res
+
+    def inc(self, field_name, amount=1):
+        return self.update_ops({"$inc": {field_name: amount}})
+
+    def push(self, field_name, value):
+        return self.update_ops({"$push": {field_name: value}})
+
+    def add_to_set(self, field_name, value):
+        return self.update_ops({"$addToSet": {field_name: value}})
+
+    def pull(self, field_name, value):
+        """Removes every item equal to `value`, or with the fields of the
+        document `value`. Conditions ({"$gte": 5}) are not supported."""
+        return self.update_ops({"$pull": {field_name: value}})
+
     def _check_attrs(self, *field_names):
         """Ensures that all fields are set correctly."""
         if not field_names:
-            field_names = self._fields.keys()
+            for field_name, field in self._plan.checks:
+                field.check(self.get(field_name, mago.UnSet))
+            return
 
         declared_fields = self._fields.keys()
         for field_name in field_names:
@@ -187,8 +531,8 @@ class Model(dict, Entity, metaclass=NewModelClass):
     # setters
     @mago.decorators.track_changes
     def __setitem__(self, key, value):
-        if value.__class__ is dict and value.get("__class__"):
-            value = dict_to_obj(value)
+        if value.__class__ is dict and mago.codec.TYPE_KEY in value:
+            value = mago.codec.decode(value)
 
         if key in self._fields.keys():
             self._fields[key].__set__(self, value)
@@ -196,9 +540,14 @@ class Model(dict, Entity, metaclass=NewModelClass):
             dict.__setitem__(self, key, value)
 
     def __getitem__(self, key):
+        field = self._fields.get(key)
+        if isinstance(field, mago.field.AbstractRelation):
+            # relations always go through the descriptor
+            return field.__get__(self, self.__class__)
         res = self.get(key, mago.UnSet)
-        return res if not res is mago.UnSet\
-          else self._fields[key].__get__(self, key)
+        if res is mago.UnSet and field is not None:
+            return field.__get__(self, self.__class__)
+        return res
 
     # del
     @mago.decorators.track_changes
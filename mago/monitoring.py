@@ -0,0 +1,140 @@
+"""Query instrumentation. Listeners are called with a QueryEvent after every
+find, find_one, count, aggregate, save, sync, delete and bulk write:
+
+    def log(event):
+        if event.explain:
+            logger.warning("slow %s on %s: %s", event.operation,
+                           event.collection, event.explain)
+
+    mago.monitoring.add_listener(log)
+    mago.monitoring.slow_queries(0.1)      # explain() reads over 100ms
+
+Finds are reported when the cursor is exhausted or closed, with the time
+spent fetching documents. Nothing is measured while there are no listeners.
+Reads that don't go through a model (i.e. relation edges) use find() and
+count() of this module.
+"""
+import time
+
+
+_listeners = []
+_slow_threshold = None
+
+READS = frozenset(("find", "find_one", "count"))
+
+
+class QueryEvent(object):
+    """What was sent to the db and how long it took (in seconds).
+    `count` is the number of documents returned or written. `explain` is
+    the explain() output of slow reads."""
+
+    __slots__ = ("model", "collection", "operation", "filter", "projection",
+                 "sort", "duration", "count", "explain")
+
+    def __init__(self, model, operation, filter=None, projection=None,
+                 sort=None, collection=None):
+        self.model = model
+        self.collection = collection or model.collection_name()
+        self.operation = operation
+        self.filter = filter
+        self.projection = projection
+        self.sort = sort
+        self.duration = 0.0
+        self.count = 0
+        self.explain = None
+
+    def __repr__(self):
+        return "QueryEvent({} {} {!r}, {} docs in {:.6f}s)".format(
+            self.operation, self.collection, self.filter, self.count,
+            self.duration)
+
+
+def explainer(coll, spec, projection=None):
+    """The `explain` callable of a find on `coll`"""
+    return lambda: coll.find(spec, projection).explain()
+
+
+def find(coll, spec, projection=None, model=None):
+    """Iterates over coll.find(spec, projection), the find is reported
+    when the iteration ends"""
+    if not _listeners:
+        yield from coll.find(spec, projection)
+        return
+    event = QueryEvent(model, "find", filter=spec, projection=projection,
+                       collection=coll.name)
+    cursor = coll.find(spec, projection)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                doc = next(cursor)
+            except StopIteration:
+                return
+            finally:
+                event.duration += time.perf_counter() - start
+            event.count += 1
+            yield doc
+    finally:
+        publish(event, explainer(coll, spec, projection))
+
+
+def count(coll, spec, model=None):
+    """coll.find(spec).count(), reported as a count"""
+    with watch(model, "count", explainer(coll, spec), filter=spec,
+               collection=coll.name) as event:
+        event.count = coll.find(spec).count()
+    return event.count
+
+
+def add_listener(listener):
+    """`listener` is called with every QueryEvent"""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def enabled():
+    return bool(_listeners)
+
+
+def slow_queries(threshold):
+    """Attaches the explain() output to the events of the reads that take
+    more than `threshold` seconds. None disables it."""
+    global _slow_threshold
+    _slow_threshold = threshold
+
+
+def publish(event, explain=None):
+    """Sends `event` to the listeners. `explain` is called to explain the
+    query when it's a slow read."""
+    if explain is not None and _slow_threshold is not None and \
+       event.operation in READS and event.duration >= _slow_threshold:
+        event.explain = explain()
+    for listener in list(_listeners):
+        listener(event)
+
+
+class watch(object):
+    """Times the block and publishes the event it returns, i.e.
+
+        with watch(Model, "save", filter={"_id": oid}) as event:
+            ...
+            event.count = 1
+    """
+
+    __slots__ = ("event", "explain", "_start")
+
+    def __init__(self, model, operation, explain=None, **kwargs):
+        self.event = QueryEvent(model, operation, **kwargs)
+        self.explain = explain
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self.event
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and _listeners:
+            self.event.duration = time.perf_counter() - self._start
+            publish(self.event, self.explain)
@@ -0,0 +1,373 @@
+"""Unit of work. A session tracks the state of the models attached to it
+and writes the pending changes on commit."""
+
+import asyncio
+import copy
+import functools
+import weakref
+import mago
+import mago.aio
+import mago.cursor
+import mago.field
+import mago.monitoring
+import mago.types
+
+
+# max number of operations sent in one bulk write
+BULK_BATCH_SIZE = 1000
+
+
+def _key(model):
+    return (model.collection_name(), model.id)
+
+
+def _copy(model, doc):
+    """Copy of `doc`, relations are not copied (they are models)"""
+    res = {}
+    for key, val in doc.items():
+        if isinstance(model._fields.get(key), mago.field.AbstractRelation):
+            res[key] = val
+        else:
+            res[key] = copy.deepcopy(val)
+    return res
+
+
+def _without(update, names):
+    """`update` without the operators on the fields `names`"""
+    res = {}
+    for oper, fields in update.items():
+        fields = {name: value for name, value in fields.items()
+                  if name not in names}
+        if fields:
+            res[oper] = fields
+    return res
+
+
+def batches(ops, size=BULK_BATCH_SIZE):
+    for start in range(0, len(ops), size):
+        yield ops[start:start + size]
+
+
+def bulk_write(coll, ops, ordered=True, batch_size=BULK_BATCH_SIZE):
+    """Sends `ops`, a list of (oper, spec, doc) with oper in "insert",
+    "replace" (upsert), "update" or "remove", with bulk writes of
+    `batch_size` operations at most."""
+    modelcls = mago.types.models.get(coll.name)
+    for batch in batches(ops, batch_size):
+        with mago.monitoring.watch(modelcls, "bulk",
+                                   collection=coll.name) as event:
+            _bulk_execute(coll, batch, ordered)
+            event.count = len(batch)
+            if mago.monitoring.enabled():
+                event.filter = [spec for _, spec, _ in batch]
+
+
+def _bulk_execute(coll, batch, ordered):
+    if ordered:
+        bulk = coll.initialize_ordered_bulk_op()
+    else:
+        bulk = coll.initialize_unordered_bulk_op()
+    for oper, spec, doc in batch:
+        if oper == "insert":
+            bulk.insert(doc)
+        elif oper == "replace":
+            bulk.find(spec).upsert().replace_one(doc)
+        elif oper == "update":
+            bulk.find(spec).update_one(doc)
+        else:
+            bulk.find(spec).remove_one()
+    bulk.execute()
+
+
+def bulk_requests(ops):
+    """The (oper, spec, doc) ops as pymongo (>= 3) bulk_write() requests"""
+    from pymongo import InsertOne, ReplaceOne, UpdateOne, DeleteOne
+    requests = []
+    for oper, spec, doc in ops:
+        if oper == "insert":
+            requests.append(InsertOne(doc))
+        elif oper == "replace":
+            requests.append(ReplaceOne(spec, doc, upsert=True))
+        elif oper == "update":
+            requests.append(UpdateOne(spec, doc))
+        else:
+            requests.append(DeleteOne(spec))
+    return requests
+
+
+class Session(object):
+    """Keeps track of NEW, CLEAN, DIRTY and DELETED models. Every document
+    is materialized once per session: `_pool` is a weak-valued identity
+    map keyed by (collection, _id).
+
+    Pending changes are written with one bulk write per collection (split
+    in chunks of `batch_size` operations), `ordered` as in pymongo."""
+
+    NEW = "new"
+    CLEAN = "clean"
+    DIRTY = "dirty"
+    DELETED = "deleted"
+
+    def __init__(self, ordered=True, batch_size=BULK_BATCH_SIZE):
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self._pool = weakref.WeakValueDictionary()  # (coll, id) => model
+        self._bkp_pool = {}                # (coll, id) => clean snapshot
+        self._dirty = {}                   # (coll, id) => keys != snapshot
+        self._finalizers = {}              # (coll, id) => weakref.finalize
+        self._states = {
+            Session.NEW: set(),
+            Session.DIRTY: set(),
+            Session.DELETED: set(),
+            # clean models are only kept alive by their owners
+            Session.CLEAN: weakref.WeakSet(),
+        }
+        self._operations = []               # [(func, args, kwargs)]
+        self._updates = []                  # [(model, update)]
+        self._rollbacks = []                # [(func, args)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        self.close()
+
+    @property
+    def is_active(self):
+        return self._states is not None
+
+    def _set_state(self, model, state):
+        if model._state is not None:
+            self._states[model._state].discard(model)
+        if state is not None:
+            self._states[state].add(model)
+        model._state = state
+
+    def _attach(self, model, state):
+        key = _key(model)
+        model._session = self
+        if self._pool.get(key) is not model:
+            self._pool[key] = model
+            self._unwatch(key)
+            # forget the snapshot with the model
+            self._finalizers[key] = weakref.finalize(model, self._forget, key)
+        self._set_state(model, state)
+        if state is Session.CLEAN:
+            # copy of the document used to detect changes and to rollback
+            self._bkp_pool[key] = _copy(model, model)
+            self._dirty.pop(key, None)
+            model._clear_changes()
+
+    def _detach(self, model):
+        key = _key(model)
+        self._set_state(model, None)
+        if self._pool.get(key) is model:
+            self._pool.pop(key, None)
+            self._bkp_pool.pop(key, None)
+            self._dirty.pop(key, None)
+            self._unwatch(key)
+        model._session = None
+
+    def _unwatch(self, key):
+        finalizer = self._finalizers.pop(key, None)
+        if finalizer is not None:
+            finalizer.detach()
+
+    def _forget(self, key):
+        """Called when the instance of `key` dies"""
+        self._finalizers.pop(key, None)
+        self._bkp_pool.pop(key, None)
+        self._dirty.pop(key, None)
+
+    def _lookup(self, modelcls, oid):
+        """Returns the instance of the identity map, or None"""
+        return self._pool.get((modelcls.collection_name(), oid))
+
+    def _register_clean(self, model):
+        """Attachs a model just loaded from the db. If the document was
+        already materialized in this session, the existing instance is
+        returned instead."""
+        existing = self._pool.get(_key(model))
+        if existing is not None:
+            return existing
+        self._attach(model, Session.CLEAN)
+        return model
+
+    def _register_change(self, model, name, old):
+        """Only `name` is compared with the snapshot, the model is dirty
+        while any of its keys differ"""
+        if model._state not in (Session.CLEAN, Session.DIRTY):
+            return
+        key = _key(model)
+        snapshot = self._bkp_pool.get(key, {})
+        dirty = self._dirty.setdefault(key, set())
+        if dict.get(model, name, mago.UnSet) == \
+           snapshot.get(name, mago.UnSet):
+            dirty.discard(name)
+        else:
+            dirty.add(name)
+        self._set_state(model, Session.DIRTY if dirty else Session.CLEAN)
+
+    def add(self, model):
+        """Attachs a new model to the session"""
+        if model._session is self:
+            return model
+        if model._session is not None:
+            raise ValueError("{} belongs to another session".format(model))
+        existing = self._pool.get(_key(model))
+        if existing is not None:
+            raise ValueError("{} is already in the session".format(model))
+        self._attach(model, Session.NEW)
+        return model
+
+    def add_all(self, models):
+        if isinstance(models, mago.cursor.Cursor):
+            # models loaded from now on will be clean
+            models._mago_session = self
+        for model in models:
+            self.add(model)
+
+    def add_operation(self, func, *args, **kwargs):
+        """Queues a call to be done on commit"""
+        self._operations.append((func, args, kwargs))
+
+    def add_rollback(self, func, *args):
+        """Queues a call to be done on rollback, i.e. to undo in memory
+        what a queued operation will write. They run in reverse order."""
+        self._rollbacks.append((func, args))
+
+    def _register_update(self, model, update):
+        """Queues an update (i.e. atomic operators) of a model"""
+        self._updates.append((model, update))
+
+    def delete(self, model):
+        """Marks a model to be removed on commit. A model that does not
+        belong to the session is considered persisted."""
+        if model._session is not self:
+            if model._session is not None:
+                raise ValueError("{} belongs to another session".format(model))
+            if self._pool.get(_key(model)) is not None:
+                raise ValueError("{} is already in the session".format(model))
+            self._attach(model, Session.CLEAN)
+        if model._state is Session.NEW:
+            self._detach(model)
+        else:
+            self._set_state(model, Session.DELETED)
+
+    def _batches(self, ops):
+        return batches(ops, self.batch_size)
+
+    def _bulk_write(self, coll, ops):
+        bulk_write(coll, ops, self.ordered, self.batch_size)
+
+    def _pending(self):
+        """The pending writes by collection, as
+        {name: (modelcls, [(oper, spec, doc)])} where oper is "replace",
+        "update" or "remove"."""
+        pending = {}
+
+        def _add(model, oper, doc):
+            _, ops = pending.setdefault(model.collection_name(),
+                                        (model.__class__, []))
+            ops.append((oper, {"_id": model.id}, doc))
+
+        for model in self._states[Session.NEW]:
+            model._check_attrs()
+            _add(model, "replace", model._store())
+        for model in self._states[Session.DIRTY]:
+            model._check_attrs()
+            doc = model._update_spec()
+            if doc:
+                _add(model, "update", doc)
+        for model, update in self._updates:
+            # fields set or deleted afterwards are sent with their value
+            update = _without(update, model._changed | model._deleted)
+            if update:
+                _add(model, "update", update)
+        for model in self._states[Session.DELETED]:
+            _add(model, "remove", None)
+        return pending
+
+    def flush(self):
+        """Writes every pending change to the db, with one bulk write per
+        collection"""
+        for modelcls, ops in self._pending().values():
+            self._bulk_write(modelcls.collection(), ops)
+
+        for func, args, kwargs in self._operations:
+            func(*args, **kwargs)
+        self._flushed()
+
+    async def aflush(self):
+        """Same as flush(), through the async driver. Calls queued with
+        add_operation() are blocking, they run in the default executor."""
+        for modelcls, ops in self._pending().values():
+            driver = mago.aio.get_driver(modelcls._db_alias)
+            for batch in self._batches(ops):
+                with mago.monitoring.watch(modelcls, "bulk") as event:
+                    await driver.bulk_write(modelcls.collection_name(), batch,
+                                            self.ordered)
+                    event.count = len(batch)
+
+        loop = asyncio.get_event_loop()
+        for func, args, kwargs in self._operations:
+            await loop.run_in_executor(
+                None, functools.partial(func, *args, **kwargs))
+        self._flushed()
+
+    def _flushed(self):
+        self._operations = []
+        self._updates = []
+        self._rollbacks = []
+        for model in list(self._states[Session.DELETED]):
+            self._detach(model)
+        for state in (Session.NEW, Session.DIRTY):
+            for model in list(self._states[state]):
+                self._attach(model, Session.CLEAN)
+
+    def commit(self):
+        """Writes every pending change to the db"""
+        self.flush()
+
+    async def acommit(self):
+        await self.aflush()
+
+    def rollback(self):
+        """Discards every pending change"""
+        self._operations = []
+        self._updates = []
+        rollbacks, self._rollbacks = self._rollbacks, []
+        for func, args in reversed(rollbacks):
+            func(*args)
+        for model in list(self._states[Session.NEW]):
+            self._detach(model)
+
+        for state in (Session.DIRTY, Session.DELETED):
+            for model in list(self._states[state]):
+                bkp = self._bkp_pool[_key(model)]
+                dict.clear(model)
+                dict.update(model, _copy(model, bkp))
+                model._refs.clear()
+                self._attach(model, Session.CLEAN)
+
+    def close(self):
+        """Detachs every model and destroys the session"""
+        for model in list(self._pool.values()):
+            model._session = None
+            model._state = None
+        for finalizer in self._finalizers.values():
+            finalizer.detach()
+        self._bkp_pool.clear()
+        self._dirty.clear()
+        self._pool = None
+        self._bkp_pool = None
+        self._dirty = None
+        self._finalizers = None
+        self._states = None
+        self._operations = None
+        self._updates = None
+        self._rollbacks = None
@@ -1,16 +1,64 @@
-"""It support transaction using the two-steps commit """
+"""Transactions over several documents. They are applied by a backend:
+native server-side transactions when the server supports them, else a
+two-phase commit (see recovery()).
+
+    t = Transaction()
+    t.insert(new_models)
+    t.update(changed_models)
+    t.remove(old_models)
+    t.commit()
+"""
+import datetime
+import threading
+import weakref
+import pymongo
+import mago.connection
+import mago.index
 import mago.model
+import mago.session
+import mago.types
+from bson import BSON
 from bson.objectid import ObjectId
 
+# max number of transactions recovered at once
+RECOVERY_BATCH_SIZE = 100
+
+# new documents larger than this (in bytes) are not embedded in the
+# transaction document
+INLINE_BODY_SIZE = 64 * 1024
+
+# seconds since its last write during which a transaction is considered
+# alive, recovery leaves it alone
+LEASE_TIME = 60
+
+# states of the transactions that recovery has to finish
+UNFINISHED = ['initial', 'pending', 'commit']
+
+
+def _id(entry):
+    """The id of a model, a document or an id"""
+    if type(entry) is ObjectId:
+        return entry
+    return entry["_id"]
+
+
+def _unapplied(models):
+    """Entries already written are replaced by their ids on recovery"""
+    return [model for model in models if type(model) is not ObjectId]
+
+
 class Transaction(mago.model.Model):
+    class Meta:
+        indexes = [["state", "_id"]]
+
     def __init__(self, **kwargs):
         mago.model.Model.__init__(self, **kwargs)
         if self.get('new', None) is None:
-            self['new'] = {}                  # coll => [mdoel]
+            self['new'] = {}                  # coll => [model]
         if self.get('del', None) is None:
             self['del'] = {}                  # coll => [id]
         if self.get('update', None) is None:
-            self['update'] = {}               # coll => [min_model]
+            self['update'] = {}               # coll => [model]
         if self.get('state', None) is None:
             self['state'] = 'initial'
 
@@ -41,7 +89,7 @@ class Transaction(mago.model.Model):
 
     def remove(self, model_or_sequence):
         def _delete_model(tran, model):
-            if model.collection not in tran['del']:
+            if model.collection_name() not in tran['del']:
                 tran['del'][model.collection_name()] = []
             tran['del'][model.collection_name()].append(model.id)
 
@@ -51,77 +99,149 @@ class Transaction(mago.model.Model):
             for model in model_or_sequence:
                 _delete_model(self, model)
 
-    def _to_pending(self):
-        self['state'] = 'pending'
-        self.sync()
+    def _switch(self, state):
+        """Moves to `state`, only the state and the lease are written"""
+        dict.__setitem__(self, 'state', state)
+        dict.__setitem__(self, 'lease', datetime.datetime.utcnow())
+        self.collection().update({"_id": self.id}, {"$set": {
+            "state": state, "lease": self['lease']}})
 
-        for coll in self['new'].values():
-            for model in coll:
-                if self.id in model['_trans']:
-                    continue
-                model['_trans'].append(self.id)
-                model.save()
+    @classmethod
+    def _bodies(cls):
+        """Where the large new documents are kept"""
+        return cls.collection()["bodies"]
 
-        for coll, ids in self['del'].items():
-            model_class = mago.types.models[coll]
-            for model_id in ids:
-                # TODO: If it was already remove?
-                model_class.collection().remove({"_id": model_id})
-
-        for coll in self['update'].values():
-            for model in coll:
-                if self.id in model['_trans']:
-                    continue
-                model['_trans'].append(self.id)
-                model.sync()
+    def _log(self):
+        """The compact log of the new and updated documents, as
+        ({coll: [entry]}, {coll: [entry]}). New entries are {_id, doc}, or
+        just {_id} when the body is kept out of line. Update entries are
+        {_id, set, unset}, only the changed fields."""
+        new = {}
+        for coll, models in self['new'].items():
+            entries = new[coll] = []
+            for model in _unapplied(models):
+                if isinstance(model, mago.model.Model):
+                    model._check_attrs()
+                    model = {"_id": model.id, "doc": model._store()}
+                entries.append(model)
 
-    def _to_commit(self):
-        self['state'] = 'commit'
-        self.sync()
+        update = {}
+        for coll, models in self['update'].items():
+            entries = update[coll] = []
+            for model in _unapplied(models):
+                if isinstance(model, mago.model.Model):
+                    model._check_attrs()
+                    spec = model._update_spec() or {}
+                    changes = spec.get("$set", {})
+                    changes.pop("_trans", None)
+                    model = {"_id": model.id, "set": changes,
+                             "unset": list(spec.get("$unset", ()))}
+                entries.append(model)
+        return new, update
+
+    def save(self, *args, **kwargs):
+        """Stores the compact log, the new documents larger than
+        INLINE_BODY_SIZE go to the bodies collection."""
+        self._check_attrs()
+        new, update = self._log()
+        outline = []
+        for coll, entries in new.items():
+            for i, entry in enumerate(entries):
+                if len(BSON.encode(entry["doc"])) > INLINE_BODY_SIZE:
+                    outline.append({"tran": self.id, "coll": coll,
+                                    "doc": entry["doc"]})
+                    entries[i] = {"_id": entry["_id"]}
+        if outline or self.get('bodies'):
+            self._bodies().remove({"tran": self.id})
+        if outline:
+            self._bodies().insert(outline)
+        dict.__setitem__(self, 'bodies', bool(outline))
+
+        dict.__setitem__(self, 'lease', datetime.datetime.utcnow())
+        store = mago.model.Model._store(self)
+        store['new'] = new
+        store['update'] = update
+        self.collection().save(store, *args, **kwargs)
+        self._clear_changes()
+        return self
+
+    def delete(self):
+        if self.get('bodies'):
+            self._bodies().remove({"tran": self.id})
+        return mago.model.Model.delete(self)
+
+    def _writes(self, stamp=True):
+        """coll => [(oper, spec, doc)] for the new and updated documents,
+        stamped with the transaction id if `stamp`"""
+        writes = {}
+        new, update = self._log()
+        for coll, entries in new.items():
+            ops = writes.setdefault(coll, [])
+            for entry in entries:
+                doc = entry["doc"]
+                trans = doc.get('_trans', [])
+                if stamp and self.id not in trans:
+                    doc = dict(doc, _trans=trans + [self.id])
+                ops.append(("replace", {"_id": entry["_id"]}, doc))
 
-        for coll in self['new'].values():
-            for model in coll:
-                model['_trans'].remove(self.id)
-                model.sync()
+        for coll, entries in update.items():
+            ops = writes.setdefault(coll, [])
+            for entry in entries:
+                spec = {}
+                if entry.get("set"):
+                    spec["$set"] = entry["set"]
+                if entry.get("unset"):
+                    spec["$unset"] = dict.fromkeys(entry["unset"], "")
+                if stamp:
+                    spec["$addToSet"] = {"_trans": self.id}
+                if spec:
+                    ops.append(("update", {"_id": entry["_id"]}, spec))
+        return writes
 
-        for coll in self['update'].values():
-            for model in coll:
-                model['_trans'].remove(self.id)
-                model.sync()
+    def _written(self):
+        for oper in ('new', 'update'):
+            for models in self[oper].values():
+                for model in models:
+                    if isinstance(model, mago.model.Model):
+                        model._clear_changes()
 
-        self['state'] = 'finished'
-        self.sync()
+    def _to_pending(self):
+        """Writes every change with one bulk write per collection. The
+        touched documents are stamped with the transaction id."""
+        self._switch('pending')
+
+        for coll, ops in self._writes().items():
+            mago.session.bulk_write(mago.types.models[coll].collection(), ops,
+                                    ordered=False)
+        for coll, ids in self['del'].items():
+            # TODO: If it was already remove?
+            mago.types.models[coll].collection().remove({"_id": {"$in": ids}})
+        self._written()
+
+    def _touched(self):
+        """coll => [id] of the new and updated documents"""
+        touched = {}
+        for oper in ('new', 'update'):
+            for coll, models in self[oper].items():
+                touched.setdefault(coll, []).extend(_id(m) for m in models)
+        return touched
+
+    def _unstamp(self, coll, ids):
+        mago.types.models[coll].collection().update(
+            {"_id": {"$in": ids}, "_trans": self.id},
+            {"$pull": {"_trans": self.id}}, multi=True)
+
+    def _to_commit(self):
+        self._switch('commit')
+        for coll, ids in self._touched().items():
+            self._unstamp(coll, ids)
+        self._switch('finished')
 
     def commit(self):
-        try:
-            self.save()
-            self._to_pending()
-            self._to_commit()
-            self.delete()
-            # TODO: Find out what exceptions are raised
-        except:
-            # something wring happend
-            self.rollback()
-            raise IOError("Rollback!")
+        get_backend(self).commit(self)
 
     def rollback(self):
-        # delete new documents
-        for coll, models in self["new"]:
-            model_class = mago.types.models[coll]
-            for model in models:
-                model['_trans'].pop(self.id, None)
-                model_class.collection().remove({"_id", model.id})
-
-        for models in self['del'].values():
-            for model in models:
-                model["_trans"].pop(self.id, None)
-                model.sync()            # TODO: check it!
-
-        for models in self['update'].values():
-            for model in models:
-                model['_trans'].pop(self.id, None)
-                model.sync()
-        self.delete()
+        get_backend(self).rollback(self)
 
     def recover(self):
         if self['state'] == 'initial' or self['state'] == 'pending':
@@ -134,23 +254,262 @@ class Transaction(mago.model.Model):
             self.delete()
 
 
-def recovery():
-    Transaction.collection().remove({"state" : "finished"})
-    trans = Transaction.find()
-    for t in trans:
-        for oper in t:
-            if not  oper in ('new', 'update', 'del'):
-                continue
+mago.index.declare(Transaction.collection_name() + ".bodies",
+                   mago.index.Index("tran"))
+
+
+class TransactionBackend(object):
+    """Interface of the backends that apply a Transaction"""
+
+    def commit(self, tran):
+        raise NotImplementedError()
+
+    def rollback(self, tran):
+        raise NotImplementedError()
+
+
+class TwoPhaseCommit(TransactionBackend):
+    """The transaction document is stored and the touched documents are
+    stamped with its id, so that recovery() can finish it after a crash.
+    Works with any server."""
+
+    def commit(self, tran):
+        try:
+            tran.save()
+            tran._to_pending()
+            tran._to_commit()
+            tran.delete()
+            # TODO: Find out what exceptions are raised
+        except:
+            # something wring happend
+            if self.rollback(tran):
+                raise IOError("Rollback!")
+            raise IOError("Transaction {} interrupted, recovery() will "
+                          "finish it".format(tran.id))
+
+    def rollback(self, tran):
+        """Discards a transaction that did not write anything yet. Once
+        it is past the initial state the writes can't be undone, the
+        document is kept so that recovery() rolls it forward. Returns
+        whether it was discarded."""
+        if tran['state'] != 'initial':
+            return False
+        tran.delete()
+        return True
+
+
+class NativeTransaction(TransactionBackend):
+    """Runs the whole transaction inside one server-side transaction
+    (replica sets and sharded clusters, MongoDB >= 4.0), with one bulk
+    write per collection. Nothing is stored besides the documents.
+    Requires pymongo >= 3.7, older drivers have no transactions and
+    always use the two-phase commit."""
+
+    def __init__(self, client=None):
+        self.client = client
+
+    @staticmethod
+    def supported(client):
+        """True if `client` can run multi-document transactions"""
+        # client sessions came in pymongo 3.6, transactions in 3.7
+        session_cls = getattr(getattr(pymongo, "client_session", None),
+                              "ClientSession", None)
+        if not hasattr(client, "start_session") or \
+           not hasattr(session_cls, "start_transaction"):
+            return False
+        try:
+            info = client.admin.command("ismaster")
+        except Exception:
+            return False
+        return (info.get("maxWireVersion", 0) >= 7 and
+                bool(info.get("setName") or info.get("msg") == "isdbgrid"))
+
+    def _bulk_write(self, coll, ops, session):
+        coll.bulk_write(mago.session.bulk_requests(ops), ordered=False,
+                        session=session)
+
+    def _delete(self, coll, ids, session):
+        coll.delete_many({"_id": {"$in": ids}}, session=session)
+
+    def commit(self, tran):
+        client = self.client or _client(tran)
+        writes = tran._writes(stamp=False)
+        with client.start_session() as session:
+            # aborted if anything fails
+            with session.start_transaction():
+                for coll, ops in writes.items():
+                    if ops:
+                        self._bulk_write(
+                            mago.types.models[coll].collection(), ops,
+                            session)
+                for coll, ids in tran['del'].items():
+                    self._delete(mago.types.models[coll].collection(), ids,
+                                 session)
+        tran._written()
+
+    def rollback(self, tran):
+        # nothing is written before commit
+        for oper in ('new', 'update', 'del'):
+            tran[oper].clear()
+
+
+_backend = None
+_native_support = weakref.WeakKeyDictionary()    # client => bool
+TWO_PHASE_COMMIT = TwoPhaseCommit()
+
+
+def set_backend(backend):
+    """Uses `backend` for every transaction. With None (the default) native
+    transactions are used when the server supports them."""
+    global _backend
+    _backend = backend
+
+
+def _client(tran):
+    """The only client used by the models of `tran`, or None"""
+    aliases = {mago.types.models[coll]._db_alias
+               for oper in ('new', 'update', 'del') for coll in tran[oper]}
+    clients = {mago.connection.Connection().get_connection(alias)
+               for alias in aliases or {tran._db_alias}}
+    return clients.pop() if len(clients) == 1 else None
+
+
+def get_backend(tran):
+    if _backend is not None:
+        return _backend
+    client = _client(tran)
+    if client is None:
+        return TWO_PHASE_COMMIT
+    if client not in _native_support:
+        _native_support[client] = NativeTransaction.supported(client)
+    if _native_support[client]:
+        return NativeTransaction()
+    return TWO_PHASE_COMMIT
+
+
+class Recovery(object):
+    """Finishes the transactions left by a crash, oldest first, reading
+    `batch_size` of them at a time. Every write of a transaction renews
+    its lease, the ones written in the last `lease` seconds (LEASE_TIME
+    by default) are alive and skipped, so it can run in the background
+    while new transactions are committed:
+
+        Recovery(progress=print).start()
+
+    A commit that stalls for longer than the lease is recovered as if it
+    had crashed. `progress(done, total, checkpoint)` is called after
+    every batch. Every transaction up to the checkpoint is finished: it
+    doesn't move past a live transaction, which may still crash, so a
+    new Recovery(checkpoint=...) continues after it without missing
+    any."""
+
+    def __init__(self, batch_size=RECOVERY_BATCH_SIZE, progress=None,
+                 checkpoint=None, lease=None):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.lease = LEASE_TIME if lease is None else lease
+        self.done = 0
+        self.total = None
+        self._expired = None
+
+    def _spec(self, after):
+        spec = {"state": {"$in": UNFINISHED},
+                "$or": [{"lease": {"$lte": self._expired}},
+                        # written before leases existed
+                        {"lease": {"$exists": False}}]}
+        if after:
+            spec["_id"] = {"$gt": after}
+        return spec
+
+    def _oldest_alive(self, coll):
+        """The id of the oldest transaction skipped for its lease"""
+        spec = {"state": {"$in": UNFINISHED},
+                "lease": {"$gt": self._expired}}
+        if self.checkpoint:
+            spec["_id"] = {"$gt": self.checkpoint}
+        for doc in coll.find(spec, {"_id": 1}).sort("_id", mago.ASC)\
+                       .limit(1):
+            return doc["_id"]
+        return None
+
+    def _purge(self, coll):
+        """Deletes the finished transactions, `batch_size` at a time"""
+        while True:
+            finished = list(coll.find({"state": "finished"},
+                                      {"_id": 1, "bodies": 1})
+                            .limit(self.batch_size))
+            if not finished:
+                return
+            outline = [doc["_id"] for doc in finished if doc.get("bodies")]
+            if outline:
+                Transaction._bodies().remove({"tran": {"$in": outline}})
+            coll.remove({"_id": {"$in": [doc["_id"] for doc in finished]}})
+
+    @staticmethod
+    def _prepare(tran):
+        """Keeps the log entries that still have to be written. The ones
+        already stamped with the transaction id are replaced by their id,
+        they are found with one `$in` query per collection."""
+        if tran['state'] not in ('initial', 'pending'):
+            return
+        bodies = None
+        for oper in ('new', 'update'):
+            for coll, entries in tran[oper].items():
+                ids = [_id(entry) for entry in entries]
+                applied = {doc["_id"] for doc in mago.types.models[coll]
+                           .collection().find({"_id": {"$in": ids},
+                                               "_trans": tran.id},
+                                              {"_id": 1})}
+                pending = []
+                for entry in entries:
+                    if _id(entry) in applied:
+                        entry = _id(entry)
+                    elif oper == 'new' and "doc" not in entry:
+                        if bodies is None:
+                            bodies = {(body["coll"], body["doc"]["_id"]):
+                                      body["doc"] for body in
+                                      tran._bodies().find({"tran": tran.id})}
+                        entry["doc"] = bodies[(coll, entry["_id"])]
+                    pending.append(entry)
+                tran[oper][coll] = pending
+
+    def run(self):
+        """Recovers every pending transaction, returns how many"""
+        mago.index.sync_indexes(Transaction)
+        coll = Transaction.collection()
+        # the transactions written after this are alive
+        self._expired = datetime.datetime.utcnow() - \
+          datetime.timedelta(seconds=self.lease)
+        self._purge(coll)
+        alive = self._oldest_alive(coll)
+        if self.total is None:
+            self.total = coll.find(self._spec(self.checkpoint)).count()
+        last = self.checkpoint
+        while True:
+            batch = list(Transaction.find(self._spec(last))
+                         .sort("_id", mago.ASC).limit(self.batch_size))
+            if not batch:
+                break
+            for tran in batch:
+                self._prepare(tran)
+                tran.recover()
+                last = tran.id
+                if alive is None or last < alive:
+                    self.checkpoint = last
+                self.done += 1
+            if self.progress:
+                self.progress(self.done, self.total, self.checkpoint)
+        return self.done
 
-            for coll, docs in t[oper].items():
-                model_class = mago.types.models[coll]
+    def start(self):
+        """Runs the recovery in a daemon thread, which is returned"""
+        thread = threading.Thread(target=self.run, name="mago-recovery",
+                                  daemon=True)
+        thread.start()
+        return thread
 
-                models = list()
-                for doc_or_oid in docs:
-                    if type(doc_or_oid) is ObjectId:
-                        models.append(doc_or_oid)
-                        continue
-                    models.append(model_class(**doc_or_oid))
-                t[oper][coll] = models
 
-        t.recover()
+def recovery(**kwargs):
+    """Finishes every transaction left by a crash, see Recovery"""
+    return Recovery(**kwargs).run()
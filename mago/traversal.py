@@ -0,0 +1,283 @@
+"""Multi-hop traversals over the relation fields:
+
+    # every report, up to 3 levels below the given managers
+    Employee.traverse(manager_ids).via("reports").depth(3).models()
+
+    # the tags of the posts of some users
+    User.traverse(user_ids).via("posts").via("tags").ids()
+
+Every hop is one batched query over the whole frontier that only reads
+the ids (and the fields the next hop needs), the models are read at the
+end when they are needed. Nodes are visited once, so cycles end the walk,
+and the frontier is bounded by limit() while it's read. A repeated hop
+over a relation of a model with itself can be pushed down to the server
+as a `$graphLookup` with graph_lookup().
+"""
+from bson.dbref import DBRef
+import mago.cursor
+import mago.field
+import mago.monitoring
+
+
+# max number of nodes in a frontier, see Traversal.limit()
+MAX_FRONTIER = 100000
+
+
+def _aggregate(modelcls, pipeline):
+    coll = modelcls.collection()
+    with mago.monitoring.watch(modelcls, "aggregate",
+                               filter=pipeline[0]["$match"]) as event:
+        res = coll.aggregate(pipeline)
+        # pymongo 2 returns the command response
+        res = res["result"] if isinstance(res, dict) else list(res)
+        event.count = len(res)
+    return res
+
+
+class _Partial(dict):
+    """A document read with a projection, levels() reads it whole"""
+
+
+class Traversal(object):
+    """Walks from the models with ids `ids` through the relations given to
+    via(). With depth(n) the whole path is walked n times, it must end in
+    the model it starts from. The results are the models reached at the
+    end of each walk."""
+
+    def __init__(self, modelcls, ids, session=None):
+        self._model = modelcls
+        self._start = [getattr(oid, "id", oid) for oid in ids]
+        self._hops = []
+        self._depth = 1
+        self._max_frontier = MAX_FRONTIER
+        self._graph = False
+        self._levels = None             # [{id: doc or None}]
+        self.session = session
+
+    def via(self, name):
+        """Adds a hop through the relation field `name`"""
+        self._hops.append(name)
+        self._levels = None
+        return self
+
+    def depth(self, depth):
+        if depth < 1:
+            raise ValueError("depth() requires a positive number.")
+        self._depth = depth
+        self._levels = None
+        return self
+
+    def limit(self, max_frontier):
+        """A frontier with more than `max_frontier` nodes is an error"""
+        self._max_frontier = max_frontier
+        self._levels = None
+        return self
+
+    def graph_lookup(self):
+        """Runs the walk in the server with one `$graphLookup`. Requires a
+        single hop over a relation of the model with itself, and all the
+        reached documents must fit in one 16MB document."""
+        self._graph = True
+        self._levels = None
+        return self
+
+    def _plan(self):
+        """[(modelcls, field, targetcls)] for every hop of the path"""
+        if not self._hops:
+            raise ValueError("traverse() requires at least one via().")
+        plan = []
+        modelcls = self._model
+        for name in self._hops:
+            field = modelcls._fields.get(name)
+            if not isinstance(field, (mago.field.ReferenceField,
+                                      mago.field.AbstractRelation)):
+                raise mago.field.FieldError(
+                    "'{}' is not a relation of {}".format(
+                        name, modelcls.collection_name()))
+            plan.append((modelcls, field, field.model))
+            modelcls = field.model
+        if self._depth > 1 and modelcls is not self._model:
+            raise ValueError("depth() requires a path that ends in {}".format(
+                self._model.collection_name()))
+        return plan
+
+    def _check(self, frontier):
+        if len(frontier) > self._max_frontier:
+            raise ValueError("Frontier of {} nodes, the limit is {}".format(
+                len(frontier), self._max_frontier))
+
+    @staticmethod
+    def _docs(modelcls, frontier, fields=None):
+        """Reads the documents missing in `frontier` with one query. With
+        `fields`, only those are read and the ids missing the whole
+        document are the ones that are None."""
+        if fields is None:
+            missing = [oid for oid, doc in frontier.items()
+                       if doc is None or isinstance(doc, _Partial)]
+            projection = None
+        else:
+            missing = [oid for oid, doc in frontier.items() if doc is None]
+            projection = dict.fromkeys(fields, 1)
+        if missing:
+            for doc in mago.monitoring.find(
+                    modelcls.collection(), {"_id": {"$in": missing}},
+                    projection, model=modelcls):
+                frontier[doc["_id"]] = doc if projection is None \
+                  else _Partial(doc)
+        return frontier
+
+    def _reach(self, docs, key, seen, reached):
+        """Adds the `key(doc)` of the streamed `docs` that are not in
+        `seen` to `reached`, the limit is checked on every new node"""
+        try:
+            for doc in docs:
+                oid, value = key(doc)
+                if oid in seen or oid in reached:
+                    continue
+                reached[oid] = value
+                self._check(reached)
+        finally:
+            docs.close()
+        return reached
+
+    def _hop(self, modelcls, field, frontier, seen, fields):
+        """The {id: doc or None} reached from `frontier` through `field`,
+        skipping the ids in `seen`. The documents of the reached models
+        only have `_id` and the `fields` the next hop reads."""
+        ids = list(frontier)
+        if isinstance(field, mago.field.OneToMany):
+            projection = dict.fromkeys(fields, 1)
+            projection["_id"] = 1
+            return self._reach(mago.monitoring.find(
+                field.model.collection(), {field._backref: {"$in": ids}},
+                projection, model=field.model),
+                lambda doc: (doc["_id"], _Partial(doc)), seen, {})
+        if isinstance(field, mago.field.ManyToMany):
+            return self._reach(mago.monitoring.find(
+                field._collection(modelcls), {"from": {"$in": ids}},
+                {"to": 1, "_id": 0}, model=modelcls),
+                lambda edge: (edge["to"], None), seen, {})
+
+        # the ids are in the documents of the frontier
+        reached = {}
+        for doc in self._docs(modelcls, frontier,
+                              ("_id", field.field_name)).values():
+            value = doc.get(field.field_name)
+            if isinstance(value, DBRef):
+                value = value.id
+            if value is not None and value not in seen:
+                reached[value] = None
+                self._check(reached)
+        return reached
+
+    @staticmethod
+    def _reads(field):
+        """The fields of the documents that a hop through `field` reads"""
+        if isinstance(field, (mago.field.OneToMany, mago.field.ManyToMany)):
+            return ()
+        return (field.field_name,)
+
+    def _walk(self, plan):
+        visited = {}                    # coll => set(ids)
+        visited[self._model.collection_name()] = set(self._start)
+        frontier = dict.fromkeys(self._start)
+        levels = []
+        for _ in range(self._depth):
+            for index, (modelcls, field, target) in enumerate(plan):
+                seen = visited.setdefault(target.collection_name(), set())
+                following = plan[(index + 1) % len(plan)][1]
+                frontier = self._hop(modelcls, field, frontier, seen,
+                                     self._reads(following))
+                seen.update(frontier)
+                if not frontier:
+                    return levels
+            levels.append(frontier)
+        return levels
+
+    def _graph_lookup(self, plan):
+        if len(plan) != 1 or plan[0][2] is not self._model:
+            raise ValueError("graph_lookup() requires one hop over a "
+                             "relation of the model with itself.")
+        _, field, _ = plan[0]
+        if isinstance(field, mago.field.OneToMany):
+            lookup = {"from": self._model.collection_name(),
+                      "startWith": "$_id", "connectFromField": "_id",
+                      "connectToField": field._backref}
+        elif isinstance(field, mago.field.ManyToMany):
+            lookup = {"from": field._name, "startWith": "$_id",
+                      "connectFromField": "to", "connectToField": "from"}
+        elif isinstance(field, mago.field.ManyToOne):
+            lookup = {"from": self._model.collection_name(),
+                      "startWith": "$" + field.field_name,
+                      "connectFromField": field.field_name,
+                      "connectToField": "_id"}
+        else:
+            raise ValueError("graph_lookup() does not support {}".format(
+                field.__class__.__name__))
+        lookup.update({"as": "reached", "maxDepth": self._depth - 1,
+                       "depthField": "__level"})
+
+        docs = _aggregate(self._model, [
+            {"$match": {"_id": {"$in": self._start}}},
+            {"$project": {"_id": 1, field.field_name: 1}},
+            {"$graphLookup": lookup}])
+
+        edges = isinstance(field, mago.field.ManyToMany)
+        seen = set(self._start)
+        found = {}                      # id => level
+        reached = {}
+        for doc in docs:
+            for node in doc["reached"]:
+                oid = node["to"] if edges else node["_id"]
+                if oid in seen and found.get(oid, -1) <= node["__level"]:
+                    continue
+                seen.add(oid)
+                found[oid] = node["__level"]
+                if not edges:
+                    del node["__level"]
+                reached[oid] = None if edges else node
+        self._check(reached)
+
+        levels = [{} for _ in range(self._depth)]
+        for oid, level in found.items():
+            levels[level][oid] = reached[oid]
+        while levels and not levels[-1]:
+            levels.pop()
+        return levels
+
+    def run(self):
+        """Walks the graph, the results are kept"""
+        if self._levels is None:
+            plan = self._plan()
+            if self._graph:
+                self._levels = self._graph_lookup(plan)
+            else:
+                self._levels = self._walk(plan)
+        return self
+
+    @property
+    def _target(self):
+        return self._plan()[-1][2]
+
+    def ids(self):
+        """The ids of every model reached"""
+        return [oid for level in self.run()._levels for oid in level]
+
+    def levels(self):
+        """The models reached, one list per walk of the path"""
+        target = self._target
+        res = []
+        for level in self.run()._levels:
+            self._docs(target, level)
+            res.append([mago.cursor.cast(target, self.session, doc)
+                        for doc in level.values() if doc is not None])
+        return res
+
+    def models(self):
+        return [model for level in self.levels() for model in level]
+
+    def __iter__(self):
+        return iter(self.models())
+
+    def __len__(self):
+        return len(self.ids())
@@ -1,8 +1,14 @@
 """Some types definitions used in mago"""
 from datetime import datetime
 from bson.objectid  import ObjectId
+from bson.dbref import DBRef
+import pymongo
 
-NATIVE = (list, dict, tuple, int, float, bool, str, datetime, ObjectId)
+# pymongo 3 moved the read preference, the projection and the pool options
+PYMONGO3 = pymongo.version_tuple[0] >= 3
+
+NATIVE = (list, dict, tuple, int, float, bool, str, datetime, ObjectId, DBRef)
+NATIVE_SET = frozenset(NATIVE)           # for fast `type(val) in` checks
 models = {} # name => class
 
 class UnSetType:
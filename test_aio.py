@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+import asyncio
+import mago
+import mago.aio
+import mago.monitoring
+import unittest
+
+
+class Foo(mago.Model):
+    field = mago.Field()
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class MagoAsyncTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._mongo_connection = mago.connect("__test_model")
+        mago.aio.connect("__test_model")
+        Foo.collection().remove({})
+
+    def tearDown(self):
+        super().tearDown()
+        self._mongo_connection.drop_database("__test_model")
+        self._mongo_connection.close()
+
+    def test_basic_usage(self):
+        foo = Foo(field="foo", hits=1)
+        run(foo.asave())
+        self.assertEqual(Foo.find_one({"_id": foo.id}), foo)
+
+        same_foo = run(Foo.afind_one({"field": "foo"}))
+        self.assertEqual(same_foo, foo)
+        self.assertEqual(type(same_foo), Foo)
+
+        same_foo["hits"] = 2
+        run(same_foo.async_sync())
+        self.assertEqual(Foo.find_one({"_id": foo.id})["hits"], 2)
+
+        run(Foo(field="bar").asave())
+        events = []
+        mago.monitoring.add_listener(events.append)
+        try:
+            models = run(Foo.afind({}).to_list())
+        finally:
+            mago.monitoring.remove_listener(events.append)
+        self.assertEqual(sorted(m["field"] for m in models), ["bar", "foo"])
+        self.assertEqual([(e.operation, e.filter, e.count) for e in events],
+                         [("find", {}, 2)])
+
+        run(foo.adelete())
+        self.assertEqual(Foo.find_one({"_id": foo.id}), None)
+
+    def test_session(self):
+        for i in range(3):
+            Foo(field=i).save()
+        session = mago.Session()
+
+        async def work():
+            async for foo in Foo.afind({}, session=session):
+                foo["field"] += 10
+            session.add(Foo(field=20))
+            await session.acommit()
+
+        run(work())
+        fields = sorted(doc["field"] for doc in Foo.collection().find())
+        self.assertEqual(fields, [10, 11, 12, 20])
+        session.close()
+
+    def test_db_alias(self):
+        analytics = mago.connect("__test_analytics", alias="analytics")
+        mago.aio.connect("__test_analytics", alias="analytics")
+
+        class Event(mago.Model):
+            class Meta:
+                db_alias = "analytics"
+
+            name = mago.Field()
+
+        try:
+            event = Event(name="click")
+            run(event.asave())
+            self.assertEqual(Event.collection().find_one()["name"], "click")
+            self.assertEqual(run(Event.afind_one({}))["name"], "click")
+            self.assertEqual(len(run(Event.afind({}).to_list())), 1)
+            self.assertIsNone(self._mongo_connection["__test_model"]
+                              ["event"].find_one())
+            self.assertRaises(RuntimeError, mago.aio.get_driver, "nowhere")
+        finally:
+            analytics.drop_database("__test_analytics")
+            analytics.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
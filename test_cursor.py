@@ -1,10 +1,23 @@
 #!/usr/bin/python3.2
+from bson import ObjectId
 import mago
 import unittest
+from mago.cursor import RelationCursor
 
 class Foo(mago.Model):
     field = mago.Field()
 
+class Country(mago.Model):
+    name = mago.Field()
+
+class City(mago.Model):
+    name = mago.Field()
+    country = mago.ReferenceField(Country)
+
+class Street(mago.Model):
+    name = mago.Field()
+    city = mago.ReferenceField(City)
+
 class MagoModelTest(unittest.TestCase):
     def setUp(self):
         super().setUp()
@@ -14,7 +27,7 @@ class MagoModelTest(unittest.TestCase):
     def tearDown(self):
         super().tearDown()
         self._mongo_connection.drop_database("__test_model")
-        self._mongo_connection.disconnect()
+        self._mongo_connection.close()
 
     def test_basic_usage(self):
         Foo(field="hoa").save()
@@ -24,6 +37,88 @@ class MagoModelTest(unittest.TestCase):
         cursor[0]
         self.assertEqual(cursor.count(), 1)
 
+    def test_read_modes(self):
+        for i in range(3):
+            Foo(field=i, other="x", nested={"a": i, "b": "y"}).save()
+
+        docs = list(Foo.find({}).fields("field").raw())
+        self.assertEqual(len(docs), 3)
+        for doc in docs:
+            self.assertEqual(type(doc), dict)
+            self.assertEqual(sorted(doc), ["_id", "field"])
+
+        rows = list(Foo.find({}).fields("field", "nested.a").as_tuples()
+                    .sort("field", mago.ASC))
+        self.assertEqual([tuple(row) for row in rows],
+                         [(0, 0), (1, 1), (2, 2)])
+        self.assertEqual(rows[1].field, 1)
+        self.assertEqual(rows[1].nested_a, 1)
+        self.assertEqual(rows[2]._asdict(), {"field": 2, "nested_a": 2})
+        self.assertRaises(AttributeError, setattr, rows[0], "other", 1)
+
+        row = Foo.find({}).as_tuples("_id", "other")[0]
+        self.assertEqual(row.other, "x")
+
+        # partial models are only written with sync()
+        partial = Foo.find({"field": 0}).fields("field")[0]
+        self.assertNotIn("other", partial)
+        self.assertRaises(ValueError, partial.save)
+        partial["field"] = 10
+        partial.sync()
+        doc = Foo.collection().find_one({"_id": partial.id})
+        self.assertEqual((doc["field"], doc["other"]), (10, "x"))
+        self.assertRaises(ValueError, Foo.find({}).as_tuples)
+
+    def test_relation_cursor(self):
+        edges = mago.connection.Connection().get_collection("__edges")
+        edges.remove({})
+        root = Foo(field="root")
+        root.save()
+        children = [Foo(field=str(i)) for i in range(7)]
+        for child in children:
+            child.save()
+            edges.insert({"from": root.id, "to": child.id})
+        # a dangling edge is ignored
+        edges.insert({"from": root.id, "to": ObjectId()})
+
+        cursor = RelationCursor(root, Foo, edges, {"from": root.id})
+        cursor.batch_size(3)
+        self.assertEqual([m["field"] for m in cursor],
+                         [c["field"] for c in children])
+
+        cursor = RelationCursor(root, Foo, edges, {"from": root.id})
+        self.assertEqual(cursor[2], children[2])
+        self.assertEqual(type(cursor[2]), Foo)
+
+        cursor = RelationCursor(root, Foo, edges, {"from": root.id})
+        docs = list(cursor.fields("field").raw())
+        self.assertEqual(docs[0], {"_id": children[0].id, "field": "0"})
+        cursor = RelationCursor(root, Foo, edges, {"from": root.id})
+        self.assertEqual([row.field for row in cursor.as_tuples("field")],
+                         [c["field"] for c in children])
+
+    def test_prefetch(self):
+        country = Country(name="Argentina")
+        country.save()
+        cities = [City(name=name, country=country)
+                  for name in ("Cordoba", "Rosario")]
+        for city in cities:
+            city.save()
+        for i in range(10):
+            Street(name=str(i), city=cities[i % 2]).save()
+
+        streets = list(Street.find({}).prefetch("city.country"))
+        self.assertEqual(len(streets), 10)
+        for street in streets:
+            self.assertTrue("city" in street._refs)
+            city = street.city
+            self.assertEqual(city, cities[int(street["name"]) % 2])
+            self.assertTrue("country" in city._refs)
+            self.assertEqual(city.country, country)
+
+        self.assertRaises(mago.FieldError,
+                          list, Street.find({}).prefetch("name"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python3.2
+import os
+import shutil
+import tempfile
+import mago
+import unittest
+
+
+class Point(mago.Model):
+    x = mago.Field(int, required=True)
+    y = mago.Field(int)
+
+
+class Tagged(mago.Model):
+    name = mago.ConstantField(str)
+    kind = mago.EnumField(("a", "b"))
+    code = mago.Field(str, set_callback=lambda obj, val: val.upper())
+
+
+class MagoDumpTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._mongo_connection = mago.connect("__test_model")
+        Point.collection().remove({})
+        Tagged.collection().remove({})
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmp)
+        self._mongo_connection.drop_database("__test_model")
+        self._mongo_connection.close()
+
+    def _roundtrip(self, name):
+        points = [Point(x=i, y=-i).save() for i in range(1, 26)]
+        path = os.path.join(self.tmp, name)
+        calls = []
+        stats = Point.export_to(path, query={"x": {"$lte": 20}},
+                                batch_size=10, progress=lambda *args:
+                                calls.append(args))
+        self.assertEqual(stats["count"], 20)
+        self.assertEqual([call[0] for call in calls], [10, 20])
+
+        Point.collection().remove({})
+        stats = Point.import_from(path, batch_size=7)
+        self.assertEqual(stats["count"], 20)
+        self.assertEqual(Point.find({}).count(), 20)
+        same = Point.find_one({"_id": points[3].id})
+        self.assertEqual(same["y"], -4)
+        self.assertEqual(same["_trans"], [])
+
+    def test_jsonl(self):
+        self._roundtrip("points.jsonl")
+
+    def test_bson(self):
+        self._roundtrip("points.bson")
+
+    def test_validation(self):
+        path = os.path.join(self.tmp, "bad.jsonl")
+        with open(path, "w") as stream:
+            stream.write('{"x": 1}\n{"x": "one"}\n')
+        self.assertRaises(mago.FieldError, Point.import_from, path)
+        Point.import_from(path, validate=False)
+        self.assertEqual(Point.find({"x": "one"}).count(), 1)
+        self.assertRaises(ValueError, Point.import_from, path, format="csv")
+
+    def test_constant_fields(self):
+        tagged = Tagged(name="mago", kind="a").save()
+        path = os.path.join(self.tmp, "tagged.jsonl")
+        Tagged.export_to(path)
+        Tagged.collection().remove({})
+        self.assertEqual(Tagged.import_from(path)["count"], 1)
+        self.assertEqual(Tagged.find_one({"_id": tagged.id})["name"], "mago")
+
+        with open(path, "w") as stream:
+            stream.write('{"name": "mago", "kind": "c"}\n')
+        self.assertRaises(mago.FieldError, Tagged.import_from, path)
+        # through the set callbacks of the fields
+        with open(path, "w") as stream:
+            stream.write('{"name": "new", "code": "ab"}\n')
+        Tagged.import_from(path)
+        self.assertEqual(Tagged.find_one({"name": "new"})["code"], "AB")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -25,7 +25,7 @@ class MagoFieldTests(unittest.TestCase):
     def tearDown(self):
         super(MagoFieldTests, self).tearDown()
         self._mongo_connection.drop_database("__test_change_field_name")
-        self._mongo_connection.disconnect()
+        self._mongo_connection.close()
 
     def test_field(self):
 
@@ -2,7 +2,9 @@
 """ Various tests for the Model class """
 
 from mago import Field, ReferenceField, Model, connect, UnSet, OneToMany, ManyToOne
+from mago import ManyToMany
 from bson import ObjectId
+import pymongo
 import unittest
 import mago
 
@@ -26,6 +28,28 @@ class NotAModel(object):
         return "just a {wait_for_it}".format(wait_for_it=self.obj_attr)
 
 
+mago.register_codec(Bar, "bar")
+mago.register_codec(NotAModel, "notamodel")
+
+
+class Point(object):
+    __slots__ = ("x", "y")
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+mago.register_codec(Point, "pt", fields=("x", "y"))
+
+
+class Money(object):
+    def __init__(self, cents):
+        self.cents = cents
+
+mago.register_codec(Money, "money", encode=lambda m: {"c": m.cents},
+                    decode=lambda d: Money(d["c"]))
+
+
 class Foo(Model):
     field = Field()
     default = Field(default="default")
@@ -43,7 +67,7 @@ class MagoModelTest(unittest.TestCase):
     def tearDown(self):
         super().tearDown()
         _mongo_connection.drop_database("__test_model")
-        _mongo_connection.disconnect()
+        _mongo_connection.close()
 
     @unittest.skip("pinto")
     def test_model_fields_init(self):
@@ -124,6 +148,272 @@ class MagoModelTest(unittest.TestCase):
         self.assertEqual(cursor.count(), 1)
         self.assertEqual(type(cursor[0]), Small)
 
+    def test_codecs(self):
+        foo = Foo(point=Point(1, 2), price=Money(150), obj=NotAModel())
+        store = foo._store()
+        self.assertEqual(store["point"], {"x": 1, "y": 2, "__type__": "pt"})
+        self.assertEqual(store["price"], {"c": 150, "__type__": "money"})
+        self.assertEqual(store["obj"]["_so"],
+                         {"close": "almost a model", "__type__": "bar"})
+        foo.save()
+
+        same_foo = Foo.find_one({"_id": foo.id})
+        self.assertEqual((same_foo["point"].x, same_foo["point"].y), (1, 2))
+        self.assertEqual(same_foo["price"].cents, 150)
+        self.assertEqual(same_foo["obj"].method(), foo["obj"].method())
+        self.assertEqual(same_foo["obj"]._so.close, "almost a model")
+
+        self.assertRaises(TypeError, Foo(unknown=object()).save)
+        self.assertRaises(ValueError, mago.register_codec, Money, "pt")
+
+    def test_plan(self):
+        class Planned(Model):
+            plain = Field()
+            typed = Field(int, default=1)
+            required = Field(required=True)
+            enum = mago.EnumField((1, 2))
+
+        plan = Planned._plan
+        self.assertEqual([name for name, _ in plan.defaults], ["typed"])
+        self.assertEqual(sorted(plan.setters), ["enum", "typed"])
+        self.assertEqual([name for name, _ in plan.checks], ["required"])
+
+        model = Planned(plain="a", enum=2, required=True)
+        self.assertEqual(model["typed"], 1)
+        self.assertEqual(model._changed,
+                         set(["plain", "typed", "enum", "required"]))
+        self.assertRaises(mago.FieldError, Planned, typed="1")
+        self.assertRaises(mago.FieldError, Planned, enum=3)
+        self.assertRaises(mago.FieldError, Planned().save)
+
+    def test_from_db(self):
+        class Loaded(Model):
+            typed = Field(int, default=1)
+            enum = mago.EnumField((1, 2))
+
+        # trusted: no defaults, no checks, nothing to sync
+        doc = {"_id": ObjectId(), "enum": 5, "point": {"x": 1, "y": 2,
+                                                       "__type__": "pt"}}
+        model = Loaded._from_db(doc)
+        self.assertFalse("typed" in model)
+        self.assertEqual(model["enum"], 5)
+        self.assertEqual(model["point"].y, 2)
+        self.assertEqual(model["_trans"], [])
+        self.assertEqual(model._update_spec(), None)
+        self.assertTrue(model._session is None)
+
+        model["enum"] = 1
+        self.assertEqual(model._update_spec(), {"$set": {"enum": 1}})
+
+    def test_db_alias(self):
+        analytics = connect("__test_analytics", alias="analytics",
+                            pool_size=5)
+
+        class Event(Model):
+            class Meta:
+                db_alias = "analytics"
+                read_preference = pymongo.ReadPreference.SECONDARY_PREFERRED
+
+            name = Field()
+            causes = ManyToMany("__test_event_causes", "Event",
+                                bidirectional=False)
+
+        try:
+            Event(name="click").save()
+            self.assertEqual(Event.collection().database.name,
+                             "__test_analytics")
+            self.assertEqual(Foo.collection().database.name, "__test_model")
+            self.assertEqual(Event.find({})[0]["name"], "click")
+            self.assertEqual(Event.find_one({})["name"], "click")
+            self.assertEqual(Event.find({}).count(), 1)
+            # the edges live with the owner
+            load = Event(name="load").save()
+            click = Event.find_one({"name": "click"})
+            click["causes"].add(load)
+            self.assertEqual(analytics["__test_analytics"]
+                             ["__test_event_causes"].find().count(), 1)
+            self.assertEqual(list(click["causes"]), [load])
+            self.assertIn(("__test_event_causes", "from_1_to_1"),
+                          mago.sync_indexes(Event))
+            self.assertIn("from_1_to_1", analytics["__test_analytics"]
+                          ["__test_event_causes"].index_information())
+            self.assertIs(mago.connection.Connection()
+                          .get_connection("analytics"), analytics)
+        finally:
+            analytics.drop_database("__test_analytics")
+            analytics.close()
+
+    def test_lazy_collection(self):
+        # the alias is not connected yet when the model is defined
+        class Log(Model):
+            class Meta:
+                db_alias = "logs"
+
+            line = Field()
+
+        self.assertIsNone(Log._collection)
+        logs = connect("__test_logs", alias="logs")
+        try:
+            Log(line="started").save()
+            self.assertEqual(Log.collection().database.name, "__test_logs")
+            # connecting again rebinds the collection
+            connect("__test_logs2", alias="logs")
+            self.assertIsNone(Log._collection)
+            self.assertEqual(Log.collection().database.name, "__test_logs2")
+        finally:
+            logs.drop_database("__test_logs")
+            logs.close()
+
+    def test_indexes(self):
+        class Author(Model):
+            email = Field(str, unique=True)
+            name = Field(index=True)
+            books = OneToMany("Book", "author")
+
+            class Meta:
+                indexes = [[("name", pymongo.ASCENDING),
+                            ("age", pymongo.DESCENDING)],
+                           {"keys": ["country"], "sparse": True}]
+
+        class Book(Model):
+            author = ManyToOne("Author", "books")
+
+        declared = mago.index.declared_indexes([Author, Book])
+        self.assertEqual(sorted(declared["author"]),
+                         [(("country", 1),), (("email", 1),), (("name", 1),),
+                          (("name", 1), ("age", -1))])
+        self.assertTrue(declared["author"][(("email", 1),)]
+                        .options["unique"])
+        self.assertEqual(list(declared["book"]), [(("author", 1),)])
+
+        try:
+            Author.collection().create_index("name")
+            created = mago.sync_indexes(Author, Book)
+            self.assertEqual(sorted(coll for coll, _ in created),
+                             ["author", "author", "author", "book"])
+            info = Author.collection().index_information()
+            self.assertTrue(info["email_1"]["unique"])
+            self.assertTrue(info["country_1"]["sparse"])
+            self.assertIn("author_1", Book.collection().index_information())
+            # nothing missing
+            self.assertEqual(mago.sync_indexes(Author, Book), [])
+        finally:
+            Author.drop()
+            Book.drop()
+
+    def test_sync_changes(self):
+        foo = Foo(field="field", counter=1, gone="soon", tags=["a"])
+        foo.save()
+        self.assertEqual(foo._update_spec(), None)
+        self.assertEqual(foo.sync(), None)
+
+        foo["counter"] = 2
+        del foo["gone"]
+        self.assertEqual(foo._update_spec(), {"$set": {"counter": 2},
+                                              "$unset": {"gone": ""}})
+        foo.sync()
+        self.assertEqual(foo._update_spec(), None)
+
+        foo["counter"] = 2                # every assignment is sent
+        self.assertEqual(foo._update_spec(), {"$set": {"counter": 2}})
+        foo.sync()
+        foo["tags"].append("b")           # in place, not tracked
+        self.assertEqual(foo._update_spec(), None)
+        foo.mark_changed("tags")
+        self.assertEqual(foo._update_spec(), {"$set": {"tags": ["a", "b"]}})
+        foo.sync()
+
+        # the attributes of the fields
+        foo.field = "attr"
+        self.assertEqual(foo._update_spec(), {"$set": {"field": "attr"}})
+        del foo.field
+        self.assertEqual(foo._update_spec(), {"$unset": {"field": ""}})
+        foo.sync()
+        self.assertNotIn("field", Foo.collection().find_one({"_id": foo.id}))
+
+        # a mutated value assigned back, in a session too
+        with mago.Session() as session:
+            loaded = Foo.find_one({"_id": foo.id}, session=session)
+            loaded.default = loaded.default
+            self.assertIs(loaded._state, mago.Session.CLEAN)
+            tags = loaded["tags"]
+            tags.append("c")
+            loaded["tags"] = tags
+            self.assertIs(loaded._state, mago.Session.DIRTY)
+        self.assertEqual(Foo.collection().find_one({"_id": foo.id})["tags"],
+                         ["a", "b", "c"])
+
+        same_foo = Foo.find_one({"_id": foo.id})
+        self.assertEqual(same_foo._update_spec(), None)
+        self.assertEqual(same_foo["counter"], 2)
+        self.assertFalse("gone" in same_foo)
+        self.assertEqual(same_foo["tags"], ["a", "b", "c"])
+
+    def test_atomic_ops(self):
+        foo = Foo(field="field", hits=1, tags=["a"])
+        foo.save()
+        foo.inc("hits", 2)
+        foo.push("tags", "b")
+        foo.add_to_set("tags", {"$each": ["a", "c"]})
+        foo.pull("tags", "b")
+        self.assertEqual(foo["hits"], 3)
+        self.assertEqual(foo["tags"], ["a", "c"])
+        self.assertEqual(foo._update_spec(), None)
+
+        doc = Foo.collection().find_one({"_id": foo.id})
+        self.assertEqual(doc["hits"], 3)
+        self.assertEqual(doc["tags"], ["a", "c"])
+
+        self.assertRaises(mago.FieldError, foo.inc, "tags")
+        self.assertRaises(mago.FieldError, foo.push, "hits", 1)
+        self.assertRaises(mago.FieldError, foo.inc, "hits", "1")
+        self.assertRaises(ValueError, foo.update_ops, {"$rename": {}})
+        # only what the model can mirror
+        self.assertRaises(mago.FieldError, foo.pull, "tags", {"$gte": "b"})
+        self.assertRaises(mago.FieldError, foo.push, "tags",
+                          {"$each": ["d"], "$slice": -3})
+        foo.push("tags", {"$each": [{"k": 1, "v": "x"}, {"k": 2}]})
+        foo.pull("tags", {"k": 1})
+        self.assertEqual(foo["tags"], ["a", "c", {"k": 2}])
+        self.assertEqual(Foo.collection().find_one({"_id": foo.id})["tags"],
+                         foo["tags"])
+        foo.pull("tags", {"k": 2})
+
+        # queued within a session
+        session = mago.Session()
+        foo = Foo.find_one({"_id": foo.id}, session=session)
+        foo.inc("hits")
+        self.assertEqual(foo["hits"], 4)
+        self.assertEqual(
+            Foo.collection().find_one({"_id": foo.id})["hits"], 3)
+        session.commit()
+        self.assertEqual(
+            Foo.collection().find_one({"_id": foo.id})["hits"], 4)
+        session.close()
+
+        # set and updated in the same session, the $set wins
+        session = mago.Session()
+        foo = Foo.find_one({"_id": foo.id}, session=session)
+        foo["hits"] = 5
+        foo.inc("hits")
+        self.assertEqual(foo["hits"], 6)
+        session.commit()
+        self.assertEqual(
+            Foo.collection().find_one({"_id": foo.id})["hits"], 6)
+        session.close()
+
+    def test_atomic_types(self):
+        class Counter(Model):
+            hits = Field(int)
+
+        counter = Counter(hits=1).save()
+        self.assertRaises(mago.FieldError, counter.inc, "hits", 1.5)
+        self.assertEqual(counter["hits"], 1)
+        self.assertEqual(
+            Counter.collection().find_one({"_id": counter.id})["hits"], 1)
+        counter.inc("hits")
+        self.assertEqual(counter["hits"], 2)
+
     def test_relations(self):
         # 1 to *
         class User(Model):
@@ -0,0 +1,108 @@
+#!/usr/bin/python3.2
+import mago
+import mago.monitoring
+import unittest
+
+
+class Foo(mago.Model):
+    field = mago.Field()
+
+
+class Post(mago.Model):
+    tags = mago.ManyToMany("__monitoring_tags", "Tag", bidirectional=False)
+
+
+class Tag(mago.Model):
+    name = mago.Field()
+
+
+class MagoMonitoringTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._mongo_connection = mago.connect("__test_model")
+        Foo.collection().remove({})
+        self.events = []
+        mago.monitoring.add_listener(self.events.append)
+
+    def tearDown(self):
+        super().tearDown()
+        mago.monitoring.remove_listener(self.events.append)
+        mago.monitoring.slow_queries(None)
+        self._mongo_connection.drop_database("__test_model")
+        self._mongo_connection.close()
+
+    def _operations(self):
+        return [(event.operation, event.count) for event in self.events]
+
+    def test_events(self):
+        foo = Foo(field="foo").save()
+        foo["field"] = "bar"
+        foo.sync()
+        foo.sync()                      # nothing sent
+        Foo(field="baz").save()
+        self.assertEqual(Foo.find_one({"field": "bar"}), foo)
+        self.assertEqual(len(list(Foo.find({}))), 2)
+        foo.delete()
+        self.assertEqual(self._operations(),
+                         [("save", 1), ("sync", 1), ("save", 1),
+                          ("find_one", 1), ("find", 2), ("delete", 1)])
+
+        event = self.events[3]
+        self.assertIs(event.model, Foo)
+        self.assertEqual(event.collection, "foo")
+        self.assertEqual(event.filter, {"field": "bar"})
+        self.assertGreater(event.duration, 0)
+        self.assertIsNone(event.explain)
+
+    def test_bulk(self):
+        with mago.Session() as session:
+            session.add_all([Foo(field=i) for i in range(3)])
+        self.assertEqual(self._operations(), [("bulk", 3)])
+        self.assertEqual(len(self.events[0].filter), 3)
+
+    def test_slow_queries(self):
+        Foo(field="foo").save()
+        mago.monitoring.slow_queries(0)
+        Foo.find_one({"field": "foo"})
+        list(Foo.find({"field": "foo"}))
+        self.assertIsNone(self.events[0].explain)        # save
+        self.assertIsNotNone(self.events[1].explain)
+        self.assertIsNotNone(self.events[2].explain)
+
+    def test_iterate_twice(self):
+        Foo(field="foo").save()
+        del self.events[:]
+        cursor = Foo.find({})
+        self.assertEqual(len(list(cursor)), 1)
+        self.assertEqual(list(cursor), [])
+        mago.monitoring.remove_listener(self.events.append)
+        self.assertEqual(list(cursor), [])
+        mago.monitoring.add_listener(self.events.append)
+        self.assertEqual(self._operations(), [("find", 1)])
+
+        self.assertEqual(len(list(cursor.rewind())), 1)
+        self.assertEqual(Foo.find({})[0]["field"], "foo")
+        self.assertEqual(Foo.find({}).count(), 1)
+        self.assertEqual(self._operations()[1:],
+                         [("find", 1), ("find", 1), ("count", 1)])
+
+    def test_relations(self):
+        post = Post().save()
+        tags = [Tag(name=str(i)).save() for i in range(3)]
+        post.tags.set(tags)
+        del self.events[:]
+
+        mago.monitoring.slow_queries(0)
+        self.assertEqual(len([tag for tag in post.tags]), 3)
+        self.assertEqual(len(post.tags), 3)
+        self.assertEqual(
+            [(event.collection, event.operation, event.count)
+             for event in self.events],
+            [("tag", "find", 3), ("__monitoring_tags", "find", 3),
+             ("__monitoring_tags", "count", 3)])
+        for event in self.events:
+            self.assertIsNotNone(event.explain)
+
+
+if __name__ == "__main__":
+    unittest.main()
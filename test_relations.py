@@ -1,6 +1,7 @@
 #!/usr/bin/python3.2
 
-from mago import Field, Model, connect, UnSet, OneToMany, ManyToOne
+from mago import Field, Model, connect, UnSet, OneToMany, ManyToOne, \
+      ManyToMany
 from bson import ObjectId
 import unittest
 import mago
@@ -19,12 +20,29 @@ class Address(Model):
     user = ManyToOne("User", backref="addresses")
 
 
+# * to *
+class Post(Model):
+    title = Field()
+    tags = ManyToMany("post_tags", "Tag")
+
+
+class Tag(Model):
+    name = Field()
+    posts = ManyToMany("post_tags", "Post")
+
+
+class Employee(Model):
+    name = Field()
+    boss = ManyToOne("Employee", backref="reports")
+    reports = OneToMany("Employee", backref="boss")
+
+
 class RelationsTest(unittest.TestCase):
 
     def tearDown(self):
         super().tearDown()
         _mongo_connection.drop_database("__test_model")
-        _mongo_connection.disconnect()
+        _mongo_connection.close()
 
 
     def test_relations(self):
@@ -74,6 +92,230 @@ class RelationsTest(unittest.TestCase):
         self.assertEqual(hugo["addresses"], [])
         self.assertIs(home["user"], None)
 
+    def test_lazy_view(self):
+        u = User(name="injaon").save()
+        for i in range(250):
+            Address(email="{:03}@mail.com".format(i), user=u.id).save()
+
+        addresses = u["addresses"]
+        self.assertEqual(len(addresses), 250)
+        self.assertEqual([a["email"] for a in addresses[10:13]],
+                         ["010@mail.com", "011@mail.com", "012@mail.com"])
+        self.assertEqual(addresses[-1]["email"], "249@mail.com")
+        self.assertEqual(sum(1 for _ in addresses), 250)
+        self.assertIsNone(addresses._loaded)
+        # the parent is not read again
+        self.assertIs(addresses[0]["user"], u)
+
+        some = addresses.filter({"email": {"$lt": "005"}})
+        self.assertEqual(len(some), 5)
+        self.assertEqual(some.order(email=mago.DESC)[0]["email"],
+                         "004@mail.com")
+
+        # appended in memory, not saved yet
+        extra = Address(email="extra")
+        extra["user"] = u
+        self.assertEqual(len(addresses), 251)
+        self.assertIs(addresses[250], extra)
+        self.assertIs(addresses[-1], extra)
+        self.assertEqual([a["email"] for a in addresses[248:]],
+                         ["248@mail.com", "249@mail.com", "extra"])
+        self.assertEqual(addresses[0]["email"], "000@mail.com")
+        self.assertIsNone(addresses._loaded)
+
+        # the view is not a cached reference
+        u.refresh_refs()
+        self.assertIs(u["addresses"], addresses)
+        self.assertIs(u["addresses"][-1], extra)
+
+        addresses.load()
+        self.assertEqual(len(addresses._loaded), 251)
+        self.assertIs(addresses[-1], extra)
+
+        # a stored child appended is written by its sync()
+        other = User(name="other").save()
+        moved = Address.find_one({"email": "000@mail.com"})
+        other["addresses"].append(moved)
+        self.assertEqual(moved._update_spec(), {"$set": {"user": other.id}})
+        moved.sync()
+        self.assertEqual(Address.collection().find_one(
+            {"_id": moved.id})["user"], other.id)
+        with mago.Session() as session:
+            moved = Address.find_one({"_id": moved.id}, session=session)
+            u["addresses"].append(moved)
+            self.assertIs(moved._state, mago.Session.DIRTY)
+        self.assertEqual(Address.collection().find_one(
+            {"_id": moved.id})["user"], u.id)
+
+    def test_assign_diff(self):
+        u = User(name="injaon").save()
+        old = [Address(email=str(i), user=u.id).save() for i in range(10)]
+        new = [Address(email="new").save(), Address(email="unsaved")]
+
+        u["addresses"] = old[5:] + new
+        self.assertEqual(len(u["addresses"]), 7)
+        self.assertIs(new[1]["user"], u)
+        stored = Address.collection()
+        self.assertNotIn("user", stored.find_one({"_id": old[0].id}))
+        self.assertEqual(stored.find({"user": u.id}).count(), 6)
+        self.assertEqual(stored.find({"user": {"$exists": False}}).count(), 5)
+
+        # from another instance, not loaded
+        same = User.find_one({"_id": u.id})
+        del same["addresses"]
+        self.assertEqual(stored.find({"user": u.id}).count(), 0)
+        self.assertEqual(len(same["addresses"]), 0)
+
+        # queued in a session
+        with mago.Session() as session:
+            session.add(same)
+            same["addresses"] = old[:2]
+            self.assertEqual(stored.find({"user": u.id}).count(), 0)
+        self.assertEqual(stored.find({"user": u.id}).count(), 2)
+
+        # rolled back, the view and the children are as before
+        before = old[5]["user"]
+        session = mago.Session()
+        session.add(same)
+        same["addresses"] = [old[0], old[5]]
+        same["addresses"].clear()
+        self.assertIsNone(old[1]["user"])
+        session.rollback()
+        self.assertEqual(list(same["addresses"]), old[:2])
+        self.assertIs(old[1]["user"], same)
+        self.assertIs(old[5]["user"], before)
+        self.assertEqual(stored.find({"user": u.id}).count(), 2)
+        session.close()
+
+    def test_many_to_many(self):
+        post = Post(title="mago").save()
+        other = Post(title="other").save()
+        tags = [Tag(name="{:02}".format(i)).save() for i in range(12)]
+
+        post["tags"] = tags[:8]
+        post["tags"].add(tags[0], tags[8])      # tags[0] already there
+        self.assertEqual(len(post["tags"]), 9)
+        self.assertEqual([t["name"] for t in post["tags"][2:4]],
+                         [tags[2]["name"], tags[3]["name"]])
+        self.assertEqual(post["tags"][-1], tags[8])
+        self.assertEqual(set(post["tags"]), set(tags[:9]))
+
+        # the other side
+        other["tags"].add(tags[0])
+        self.assertEqual(set(tags[0]["posts"]), {post, other})
+        self.assertEqual(len(tags[11]["posts"]), 0)
+
+        post["tags"].remove(tags[1])
+        self.assertNotIn(post, list(tags[1]["posts"]))
+        post["tags"] = [tags[0], tags[10]]
+        self.assertEqual(set(post["tags"].ids()), {tags[0].id, tags[10].id})
+        self.assertEqual(set(tags[0]["posts"]), {post, other})
+
+        del post["tags"]
+        self.assertEqual(list(post["tags"]), [])
+        self.assertEqual(list(tags[0]["posts"]), [other])
+
+        # queued in a session
+        with mago.Session() as session:
+            session.add(post)
+            post["tags"].add(*tags[:3])
+            self.assertEqual(len(post["tags"]), 0)
+        self.assertEqual(len(post["tags"]), 3)
+
+        # set() diffs against the queued edges
+        with mago.Session() as session:
+            session.add(post)
+            post["tags"].add(tags[5])
+            post["tags"] = [tags[0], tags[1]]
+        self.assertEqual(set(post["tags"].ids()), {tags[0].id, tags[1].id})
+        with mago.Session() as session:
+            session.add(post)
+            post["tags"].clear()
+            post["tags"] = [tags[0]]
+        self.assertEqual(post["tags"].ids(), [tags[0].id])
+        self.assertIs(post["tags"], post["tags"])
+
+        self.assertIn((("from", 1), ("to", 1)),
+                      mago.index.declared_indexes()["post_tags"])
+        self.assertIn("post_tags", mago.index.declared_indexes([Post, Tag]))
+
+    def test_traverse(self):
+        ceo = Employee(name="ceo").save()
+        level = [ceo]
+        tree = []
+        for depth in range(4):
+            level = [Employee(name="{}.{}".format(depth, i), boss=boss.id)
+                     .save() for boss in level for i in range(2)]
+            tree.append(level)
+
+        walk = Employee.traverse([ceo.id]).via("reports").depth(3)
+        self.assertEqual([len(level) for level in walk.levels()], [2, 4, 8])
+        self.assertEqual(set(walk.ids()),
+                         {e.id for level in tree[:3] for e in level})
+        self.assertEqual(len(list(walk)), 14)
+        self.assertRaises(ValueError, Employee.traverse([ceo.id])
+                          .via("reports").depth(4).limit(10).ids)
+
+        # only the ids are read, and the reads are reported
+        events = []
+        mago.monitoring.add_listener(events.append)
+        try:
+            self.assertEqual(len(Employee.traverse([ceo.id]).via("reports")
+                                 .depth(2).ids()), 6)
+            self.assertEqual(len(Employee.traverse([ceo.id]).via("reports")
+                                 .via("boss").ids()), 0)
+        finally:
+            mago.monitoring.remove_listener(events.append)
+        self.assertEqual([(e.operation, e.projection) for e in events],
+                         [("find", {"_id": 1})] * 2 +
+                         [("find", {"_id": 1, "boss": 1})])
+
+        # up the tree, until the top
+        up = Employee.traverse(tree[3][:1]).via("boss").depth(10)
+        self.assertEqual([m["name"] for m in up],
+                         ["2.0", "1.0", "0.0", "ceo"])
+        # with a cycle, it ends in the start
+        ceo["boss"] = tree[3][0]
+        ceo.save()
+        self.assertEqual(len(up.depth(10).ids()), 4)
+
+        graph = Employee.traverse([ceo.id]).via("reports").depth(2) \
+                        .graph_lookup()
+        self.assertEqual([len(level) for level in graph.levels()], [2, 4])
+
+        # through several relations
+        post = Post(title="mago").save()
+        post["tags"] = [Tag(name=name).save() for name in ("a", "b")]
+        tags = Post.traverse([post]).via("tags")
+        self.assertEqual(sorted(t["name"] for t in tags), ["a", "b"])
+        self.assertEqual(len(Post.traverse([post]).via("tags").via("posts")
+                             .depth(1)), 0)          # only `post` itself
+        self.assertRaises(ValueError, Post.traverse([post]).via("tags")
+                          .depth(2).ids)
+
+    def test_reference_cache(self):
+        u = User(name="injaon")
+        u.save()
+        home = Address(email="injaon@gmail.com")
+        home["user"] = u
+
+        # only the id is stored, the model lives in the side cache
+        self.assertEqual(dict.get(home, "user"), u.id)
+        self.assertIs(home._refs["user"], u)
+        home.save()
+        doc = Address.collection().find_one({"_id": home.id})
+        self.assertEqual(doc["user"], u.id)
+
+        same = Address.find_one({"_id": home.id})
+        self.assertEqual(same._refs, {})
+        loaded = same["user"]
+        self.assertEqual(loaded, u)
+        self.assertIs(same["user"], loaded)
+        self.assertEqual(dict.get(same, "user"), u.id)
+
+        same.refresh_refs()
+        self.assertEqual(same._refs, {})
+        self.assertIsNot(same["user"], loaded)
 
         # TODO: test pesistance
 
@@ -21,7 +21,7 @@ class MagoModelTest(unittest.TestCase):
     def tearDown(self):
         super().tearDown()
         self._mongo_connection.drop_database("__test_model")
-        self._mongo_connection.disconnect()
+        self._mongo_connection.close()
 
     # @unittest.skip("pinto")
     def test_basic(self):
@@ -123,6 +123,19 @@ class MagoModelTest(unittest.TestCase):
         self.assertTrue(foo._state is mago.Session.DIRTY)
         foo['hola'] = "man"
         self.assertTrue(foo._state is mago.Session.CLEAN)
+        # dirty while any key differs
+        foo['hola'] = "sd"
+        foo['mano'] = "bro"
+        foo['hola'] = "man"
+        self.assertTrue(foo._state is mago.Session.DIRTY)
+        del foo['mano']
+        self.assertTrue(foo._state is mago.Session.CLEAN)
+        foo['_trans'].append("t")
+        foo.mark_changed('_trans')
+        self.assertTrue(foo._state is mago.Session.DIRTY)
+        foo['_trans'].pop()
+        foo.mark_changed('_trans')
+        self.assertTrue(foo._state is mago.Session.CLEAN)
         session.delete(foo)
         self.assertTrue(foo._state is mago.Session.DELETED)
 
@@ -139,6 +152,70 @@ class MagoModelTest(unittest.TestCase):
         self.assertTrue(foo._session is None)
         self.assertTrue(foo._state is None)
 
+    def test_identity_map(self):
+        Foo(field="same").save()
+        session = mago.Session()
+
+        foo = Foo.find_one({"field": "same"}, session=session)
+        self.assertTrue(foo._state is mago.Session.CLEAN)
+        self.assertTrue(Foo.find({"field": "same"}, session=session)[0] is foo)
+        self.assertTrue(Foo.find_one({"_id": foo.id}, session=session) is foo)
+        self.assertEqual(len(session._pool), 1)
+
+        # not in the session, not the same instance
+        self.assertFalse(Foo.find_one({"_id": foo.id}) is foo)
+
+        # the map does not keep clean models alive
+        del foo
+        self.assertEqual(len(session._pool), 0)
+        self.assertEqual(len(session._bkp_pool), 0)
+        session.close()
+
+    def test_snapshot_of_detached(self):
+        foo = Foo(field="foo").save()
+        session = mago.Session()
+        old = Foo.find_one({"_id": foo.id}, session=session)
+        session._detach(old)
+        new = Foo.find_one({"_id": foo.id}, session=session)
+        self.assertFalse(new is old)
+
+        # the detached instance does not take the snapshot with it
+        del old
+        new["field"] = "bar"
+        session.rollback()
+        self.assertEqual(new["field"], "foo")
+        session.close()
+        self.assertIsNone(session._finalizers)
+
+    def test_delete_not_loaded(self):
+        foo = Foo(field="foo").save()
+        session = mago.Session()
+        session.delete(Foo(_id=foo.id, field="foo"))
+        session.commit()
+        self.assertIsNone(Foo.find_one({"_id": foo.id}))
+        session.close()
+
+    def test_flush(self):
+        for i in range(5):
+            Foo(field=i).save()
+        session = mago.Session(ordered=False, batch_size=2)
+        it = Foo.find({})
+        session.add_all(it)
+        models = sorted(it.rewind(), key=lambda m: m["field"])
+        models[0]["field"] = 10
+        models[1]["field"] = 11
+        session.delete(models[2])
+        news = [Foo(field=20 + i) for i in range(3)]
+        session.add_all(news)
+        session.commit()
+
+        fields = sorted(doc["field"] for doc in Foo.collection().find())
+        self.assertEqual(fields, [3, 4, 10, 11, 20, 21, 22])
+        for model in models[:2] + news:
+            self.assertTrue(model._state is mago.Session.CLEAN)
+        self.assertTrue(models[2]._session is None)
+        session.close()
+
 
 if __name__ == "__main__":
     unittest.main()
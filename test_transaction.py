@@ -1,4 +1,5 @@
 #!/usr/bin/python3.2
+import datetime
 from bson import ObjectId
 import mago
 import mago.transaction as tran
@@ -13,6 +14,52 @@ class Bar(object):
 class Foo(mago.Model):
     field = mago.Field()
 
+class FakeSession(object):
+    """In-process stand-in for a pymongo ClientSession"""
+
+    def __init__(self, events):
+        self.events = events
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.events.append("end")
+
+    def start_transaction(self):
+        session = self
+
+        class _Transaction(object):
+            def __enter__(self):
+                session.events.append("start")
+
+            def __exit__(self, exc_type, *exc):
+                session.events.append("abort" if exc_type else "commit")
+        return _Transaction()
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.events = []
+
+    def start_session(self):
+        return FakeSession(self.events)
+
+
+class FakeNative(tran.NativeTransaction):
+    """Writes without a server session"""
+    fail = False
+
+    def _bulk_write(self, coll, ops, session):
+        assert isinstance(session, FakeSession)
+        if self.fail:
+            raise IOError("write failed")
+        mago.session.bulk_write(coll, ops)
+
+    def _delete(self, coll, ids, session):
+        coll.remove({"_id": {"$in": ids}})
+
+
 class MagoModelTest(unittest.TestCase):
     def setUp(self):
         super().setUp()
@@ -20,10 +67,18 @@ class MagoModelTest(unittest.TestCase):
         self._mongo_connection = mago.connect("__test_model")
         Foo.collection().remove({})
         tran.Transaction.collection().remove({})
+        tran.Transaction._bodies().remove({})
+        # every transaction left by the tests is a crashed one
+        self._lease_time, tran.LEASE_TIME = tran.LEASE_TIME, 0
+
+    def tearDown(self):
+        super().tearDown()
+        tran.LEASE_TIME = self._lease_time
+
     # def tearDown(self):
     #     super().tearDown()
     #     self._mongo_connection.drop_database("__test_model")
-    #     self._mongo_connection.disconnect()
+    #     self._mongo_connection.close()
 
     def test_insert(self):
         foo = Foo()
@@ -154,6 +209,237 @@ class MagoModelTest(unittest.TestCase):
         self.assertRaises(IndexError, lambda : \
                           tran.Transaction.collection().find()[0])
 
+    def test_commit_many(self):
+        old = [Foo(field=i).save() for i in range(10)]
+        for foo in old[:5]:
+            foo["field"] = "updated"
+        new = [Foo(field="new") for _ in range(10)]
+
+        t = tran.Transaction()
+        t.insert(new)
+        t.update(old[:5])
+        t.remove(old[5:])
+        t.commit()
+
+        self.assertEqual(Foo.collection().find({"field": "new"}).count(), 10)
+        self.assertEqual(
+            Foo.collection().find({"field": "updated"}).count(), 5)
+        self.assertEqual(Foo.collection().find().count(), 15)
+        self.assertEqual(
+            Foo.collection().find({"_trans": {"$ne": []}}).count(), 0)
+        self.assertRaises(IndexError, lambda : \
+                          tran.Transaction.collection().find()[0])
+
+    def test_interrupted_commit(self):
+        old = [Foo(field=i).save() for i in range(3)]
+        old[0]["field"] = "updated"
+
+        def fail():
+            raise IOError("connection lost")
+
+        t = tran.Transaction()
+        t.insert(Foo(field="new"))
+        t.update(old[0])
+        t.remove(old[1])
+        t._to_commit = fail
+        tran.set_backend(tran.TWO_PHASE_COMMIT)
+        try:
+            self.assertRaises(IOError, t.commit)
+        finally:
+            tran.set_backend(None)
+
+        # kept to be rolled forward
+        stored = tran.Transaction.collection().find_one({"_id": t.id})
+        self.assertEqual(stored["state"], "pending")
+        tran.recovery()
+        self.assertEqual(Foo.collection().find({"field": "new"}).count(), 1)
+        self.assertEqual(
+            Foo.collection().find({"field": "updated"}).count(), 1)
+        self.assertEqual(Foo.collection().find().count(), 3)
+        self.assertEqual(
+            Foo.collection().find({"_trans": {"$ne": []}}).count(), 0)
+        self.assertEqual(tran.Transaction.collection().find().count(), 0)
+
+        # nothing written yet, it's discarded
+        t = tran.Transaction()
+        t.insert(Foo(field="lost"))
+        t.save()
+        self.assertTrue(tran.TWO_PHASE_COMMIT.rollback(t))
+        self.assertEqual(tran.Transaction.collection().find().count(), 0)
+
+    def test_native_backend(self):
+        old = [Foo(field=i).save() for i in range(4)]
+        old[0]["field"] = "updated"
+        client = FakeClient()
+        backend = FakeNative(client)
+        tran.set_backend(backend)
+        try:
+            t = tran.Transaction()
+            t.insert(Foo(field="new"))
+            t.update(old[0])
+            t.remove(old[1:])
+            t.commit()
+            self.assertEqual(client.events, ["start", "commit", "end"])
+            self.assertEqual(Foo.collection().find().count(), 2)
+            self.assertEqual(
+                Foo.collection().find({"field": "updated"}).count(), 1)
+            # no stamps nor transaction documents
+            self.assertEqual(
+                Foo.collection().find({"_trans": {"$ne": []}}).count(), 0)
+            self.assertEqual(tran.Transaction.collection().find().count(), 0)
+
+            backend.fail = True
+            t = tran.Transaction()
+            t.insert(Foo(field="lost"))
+            self.assertRaises(IOError, t.commit)
+            self.assertEqual(client.events[-2:], ["abort", "end"])
+            t.rollback()
+            self.assertEqual(t["new"], {})
+        finally:
+            tran.set_backend(None)
+
+    def test_native_server(self):
+        if not tran.NativeTransaction.supported(self._mongo_connection):
+            self.skipTest("the server has no multi-document transactions")
+        old = [Foo(field=i).save() for i in range(3)]
+        old[0]["field"] = "updated"
+        t = tran.Transaction()
+        t.insert(Foo(field="new"))
+        t.update(old[0])
+        t.remove(old[1:])
+        self.assertIsInstance(tran.get_backend(t), tran.NativeTransaction)
+        t.commit()
+        self.assertEqual(
+            sorted(doc["field"] for doc in Foo.collection().find()),
+            ["new", "updated"])
+        self.assertEqual(tran.Transaction.collection().find().count(), 0)
+
+    def test_backend_choice(self):
+        t = tran.Transaction()
+        t.insert(Foo())
+        self.assertIsInstance(tran.get_backend(t), tran.TransactionBackend)
+        tran.set_backend(tran.TWO_PHASE_COMMIT)
+        try:
+            self.assertIs(tran.get_backend(t), tran.TWO_PHASE_COMMIT)
+        finally:
+            tran.set_backend(None)
+
+    def test_recovery_batches(self):
+        foos = [Foo(field=i) for i in range(5)]
+        for i, foo in enumerate(foos):
+            t = tran.Transaction()
+            t.insert(foo)
+            t.save()
+            if i % 3 > 0:
+                t._to_pending()
+            if i % 3 > 1:
+                # crashed before the end of the commit phase
+                t._switch('commit')
+
+        calls = []
+        recovery = tran.Recovery(batch_size=2, progress=lambda *args:
+                                 calls.append(args))
+        recovery.start().join()
+        self.assertEqual(recovery.done, 5)
+        self.assertEqual([call[:2] for call in calls],
+                         [(2, 5), (4, 5), (5, 5)])
+        self.assertEqual(calls[-1][2], recovery.checkpoint)
+        self.assertEqual(Foo.collection().find().count(), 5)
+        self.assertEqual(
+            Foo.collection().find({"_trans": {"$ne": []}}).count(), 0)
+        self.assertEqual(tran.Transaction.collection().find().count(), 0)
+
+        # resumes after the checkpoint
+        t = tran.Transaction()
+        t.insert(Foo())
+        t.save()
+        self.assertEqual(tran.recovery(checkpoint=t.id), 0)
+        self.assertEqual(tran.recovery(checkpoint=recovery.checkpoint), 1)
+
+    def test_live_transaction(self):
+        # built before the recovery and written while it runs
+        t = tran.Transaction()
+        t.insert(Foo(field="live"))
+        recovery = tran.Recovery(lease=60)
+        t.save()
+        t._to_pending()
+        self.assertEqual(recovery.run(), 0)
+        stored = tran.Transaction.collection().find_one({"_id": t.id})
+        self.assertEqual(stored["state"], "pending")
+        t._to_commit()
+        t.delete()
+        self.assertEqual(
+            Foo.collection().find({"_trans": {"$ne": []}}).count(), 0)
+
+        # once the lease expires it's recovered
+        t = tran.Transaction()
+        t.insert(Foo(field="crashed"))
+        t.save()
+        self.assertEqual(tran.Recovery(lease=0).run(), 1)
+        self.assertEqual(Foo.collection().find().count(), 2)
+
+    def test_checkpoint_alive(self):
+        coll = tran.Transaction.collection()
+        expired = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        alive = tran.Transaction()
+        alive.insert(Foo(field="alive"))
+        alive.save()
+        crashed = tran.Transaction()
+        crashed.insert(Foo(field="crashed"))
+        crashed.save()
+        coll.update({"_id": crashed.id}, {"$set": {"lease": expired}})
+        for _ in range(5):
+            coll.insert({"state": "finished"})
+
+        recovery = tran.Recovery(lease=60, batch_size=2)
+        self.assertEqual(recovery.run(), 1)
+        self.assertEqual(coll.find({"state": "finished"}).count(), 0)
+        # the checkpoint stays before the live transaction
+        self.assertIsNone(recovery.checkpoint)
+
+        # it crashes later, a run from the checkpoint recovers it
+        coll.update({"_id": alive.id}, {"$set": {"lease": expired}})
+        self.assertEqual(tran.Recovery(lease=60, checkpoint=recovery
+                                       .checkpoint).run(), 1)
+        self.assertEqual(Foo.collection().find({"_trans": []}).count(), 2)
+
+    def test_compact_log(self):
+        old = Foo(field="old", other="untouched").save()
+        old["field"] = "changed"
+        del old["other"]
+        big = Foo(field="x" * 100)
+        small = Foo(field="small")
+
+        inline_size = tran.INLINE_BODY_SIZE
+        tran.INLINE_BODY_SIZE = 64
+        try:
+            t = tran.Transaction()
+            t.insert([big, small])
+            t.update(old)
+            t.save()
+        finally:
+            tran.INLINE_BODY_SIZE = inline_size
+
+        stored = tran.Transaction.collection().find_one({"_id": t.id})
+        self.assertEqual(stored["new"]["foo"][0], {"_id": big.id})
+        self.assertEqual(stored["new"]["foo"][1]["doc"]["field"], "small")
+        self.assertEqual(stored["update"]["foo"],
+                         [{"_id": old.id, "set": {"field": "changed"},
+                           "unset": ["other"]}])
+        self.assertEqual(tran.Transaction._bodies().find().count(), 1)
+        self.assertTrue(stored["bodies"])
+
+        # replayed from the log
+        tran.recovery()
+        self.assertIn("tran_1",
+                      tran.Transaction._bodies().index_information())
+        self.assertEqual(Foo.collection().find_one({"_id": big.id})["field"],
+                         "x" * 100)
+        self.assertEqual(Foo.collection().find_one({"_id": old.id}),
+                         {"_id": old.id, "field": "changed", "_trans": []})
+        self.assertEqual(Foo.collection().find().count(), 3)
+        self.assertEqual(tran.Transaction._bodies().find().count(), 0)
+
 
 if __name__ == "__main__":
     unittest.main()
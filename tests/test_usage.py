@@ -126,20 +126,20 @@ class MagoTests(unittest.TestCase):
         self.assertTrue(isinstance(self._conn, pymongo.Connection))
         connection = Connection.instance()
         self.assertTrue(connection._database == DBNAME)
-        self._conn.disconnect()
+        self._conn.close()
 
     def test_uri_connect(self):
         conn = connect(uri="mongodb://localhost/%s" % DBNAME)
         self.assertTrue(isinstance(conn, pymongo.Connection))
         connection = Connection.instance()
         self.assertEqual(connection._database, DBNAME)
-        conn.disconnect()
+        conn.close()
         # overriding the database name
         conn = connect(DBNAME, uri="mongodb://localhost/foobar")
         self.assertTrue(isinstance(conn, pymongo.Connection))
         connection = Connection.instance()
         self.assertEqual(connection._database, DBNAME)
-        conn.disconnect()
+        conn.close()
 
     def test_model(self):
         foo = Foo(bar=u'cheese')
@@ -510,7 +510,7 @@ class MagoTests(unittest.TestCase):
         foo2 = FooWrapped()
         foo2.save(safe=True)
         self.assertEqual(coll.find().count(), 1)
-        session.disconnect()
+        session.close()
 
     def test_connection_with_statement(self):
         """ Test the with statement alternate connection """
@@ -597,7 +597,7 @@ class MagoTests(unittest.TestCase):
         if DELETE:
             self._conn.drop_database(DBNAME)
             self._conn.drop_database(ALTDB)
-        self._conn.disconnect()
+        self._conn.close()
 
 if __name__ == '__main__':
     if '--no-drop' in sys.argv: